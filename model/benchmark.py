@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import tensorflow as tf
+import keras
+from sklearn.model_selection import train_test_split
+import model as pipeline
+from generate_synthetic_data import generate_dataset
+
+# --- Configuration ---
+BENCHMARK_DATA_DIR = 'benchmark_dir'
+RESULTS_PATH = 'benchmark_results.json'
+BENCHMARK_EPOCHS = 3 # Epochs timed for training throughput (the first one includes graph tracing)
+REGRESSION_TOLERANCE = 0.15 # Report a stage as regressed if its throughput drops by more than this fraction
+FAST_DECODE_QUALITY_SAMPLES = 100 # Images compared pixel by pixel between the standard and fast decode paths
+
+class EpochThroughput(keras.callbacks.Callback):
+    """Records wall time and images/sec for every training epoch."""
+
+    def __init__(self, num_images):
+        super().__init__()
+        self.num_images = num_images
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter() - self.start
+        self.epochs.append({'epoch': epoch + 1, 'seconds': seconds, 'images_per_sec': self.num_images / seconds})
+
+class StageTimer:
+    """Collects named stage timings as {'name', 'seconds', 'items', 'items_per_sec'} records."""
+
+    def __init__(self):
+        self.stages = []
+
+    def record(self, name, seconds, items):
+        stage = {'name': name, 'seconds': round(seconds, 4), 'items': items,
+                 'items_per_sec': round(items / seconds, 2) if seconds > 0 else None}
+        self.stages.append(stage)
+        print(f"{name:<28}{seconds:>10.3f} s{items:>10} items{stage['items_per_sec'] or 0:>12.1f} items/s")
+        return stage
+
+def run_benchmark(data_dir, epochs=BENCHMARK_EPOCHS, workers=1, train=True):
+    """
+    Times each stage of the model.py pipeline separately on data_dir: directory scan, XML parse,
+    decode/crop/resize (serial, fast-decode, and with a worker pool if workers > 1), preprocess_input, split,
+    per-epoch training throughput and model.evaluate. Returns the results as a dict.
+    """
+    timer = StageTimer()
+
+    start = time.perf_counter()
+    class_names = pipeline.list_class_names(data_dir)
+    pairs = [(img_path, xml_path, class_index)
+             for class_index, class_name in enumerate(class_names)
+             for img_path, xml_path in pipeline.list_annotated_images(os.path.join(data_dir, class_name))]
+    timer.record('directory_scan', time.perf_counter() - start, len(pairs))
+
+    start = time.perf_counter()
+    samples = []
+    for img_path, xml_path, class_index in pairs:
+        bbox = pipeline.parse_bounding_box(xml_path)
+        if bbox is not None:
+            samples.append((img_path, xml_path, bbox, class_index))
+    timer.record('xml_parse', time.perf_counter() - start, len(pairs))
+
+    start = time.perf_counter()
+    images = np.array([pipeline.crop_and_resize(img_path, bbox) for img_path, _, bbox, _ in samples])
+    timer.record('decode_crop_resize', time.perf_counter() - start, len(samples))
+    labels = np.array([class_index for _, _, _, class_index in samples])
+
+    start = time.perf_counter()
+    for img_path, _, bbox, _ in samples:
+        pipeline.crop_and_resize(img_path, bbox, fast_decode=True)
+    timer.record('decode_crop_resize_fast', time.perf_counter() - start, len(samples))
+    fast_decode_quality = pipeline.check_fast_decode_quality(
+        [(img_path, bbox) for img_path, _, bbox, _ in samples[:FAST_DECODE_QUALITY_SAMPLES]])
+    print(f"Fast decode vs standard: mean abs diff {fast_decode_quality['mean_abs_diff']:.2f}, "
+          f"worst image {fast_decode_quality['worst_image_mean_abs_diff']:.2f} "
+          f"(tolerance {fast_decode_quality['tolerance']}), max pixel diff {fast_decode_quality['max_abs_diff']}")
+
+    if workers > 1:
+        start = time.perf_counter()
+        items = [(img_path, xml_path, bbox) for img_path, xml_path, bbox, _ in samples]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            loaded = sum(1 for img_array in pipeline.load_crops(items, executor=executor, num_workers=workers)
+                         if img_array is not None)
+        timer.record(f'decode_crop_resize_x{workers}', time.perf_counter() - start, loaded)
+
+    start = time.perf_counter()
+    images = tf.keras.applications.mobilenet_v2.preprocess_input(images.astype(np.float32))
+    timer.record('preprocess_input', time.perf_counter() - start, len(images))
+
+    num_classes = len(class_names)
+    start = time.perf_counter()
+    one_hot = tf.keras.utils.to_categorical(labels, num_classes=num_classes)
+    x_train, x_val, y_train, y_val = train_test_split(
+        images, one_hot, test_size=pipeline.VALIDATION_SPLIT, random_state=42,
+        stratify=one_hot if num_classes > 1 else None)
+    timer.record('split', time.perf_counter() - start, len(images))
+
+    epochs_report = []
+    if train:
+        model = pipeline.build_model(num_classes=num_classes, input_shape=(pipeline.IMG_HEIGHT, pipeline.IMG_WIDTH, 3))
+        throughput = EpochThroughput(len(x_train))
+        model.fit(x_train, y_train, batch_size=pipeline.BATCH_SIZE, epochs=epochs, callbacks=[throughput], verbose=0)
+        for epoch in throughput.epochs:
+            timer.record(f"train_epoch_{epoch['epoch']}", epoch['seconds'], len(x_train))
+        epochs_report = throughput.epochs
+        # Steady-state throughput leaves out the first epoch, which also traces the graph
+        steady = throughput.epochs[1:] or throughput.epochs
+        timer.record('train_epoch_steady', float(np.mean([e['seconds'] for e in steady])), len(x_train))
+
+        start = time.perf_counter()
+        model.evaluate(x_val, y_val, batch_size=pipeline.BATCH_SIZE, verbose=0)
+        timer.record('evaluate', time.perf_counter() - start, len(x_val))
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'data_dir': data_dir, 'num_images': len(samples), 'num_classes': num_classes,
+            'img_size': [pipeline.IMG_WIDTH, pipeline.IMG_HEIGHT], 'batch_size': pipeline.BATCH_SIZE,
+            'epochs': epochs if train else 0, 'workers': workers,
+        },
+        'environment': {
+            'python': platform.python_version(), 'tensorflow': tf.__version__, 'numpy': np.__version__,
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+        },
+        'stages': timer.stages,
+        'fast_decode_quality': fast_decode_quality,
+        'epochs': epochs_report,
+    }
+
+def compare_results(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Returns the stages whose items/sec fell by more than tolerance compared with baseline results."""
+    baseline_stages = {stage['name']: stage for stage in baseline.get('stages', [])}
+    regressions = []
+    for stage in results['stages']:
+        old = baseline_stages.get(stage['name'])
+        if not old or not old.get('items_per_sec') or not stage.get('items_per_sec'):
+            continue
+        change = stage['items_per_sec'] / old['items_per_sec'] - 1
+        if change < -tolerance:
+            regressions.append({'name': stage['name'], 'baseline_items_per_sec': old['items_per_sec'],
+                                'items_per_sec': stage['items_per_sec'], 'change': round(change, 4)})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the training pipeline and emit JSON results.")
+    parser.add_argument('--data', default=BENCHMARK_DATA_DIR, help="Dataset directory; generated if it does not exist")
+    parser.add_argument('--classes', type=int, default=4, help="Classes to generate if --data does not exist")
+    parser.add_argument('--images-per-class', type=int, default=100, help="Images per class to generate if --data does not exist")
+    parser.add_argument('--epochs', type=int, default=BENCHMARK_EPOCHS)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Also time the parallel loader with this many workers")
+    parser.add_argument('--skip-training', action='store_true', help="Only time the data stages")
+    parser.add_argument('--output', default=RESULTS_PATH)
+    parser.add_argument('--baseline', help="Earlier results file to check for throughput regressions")
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.data):
+        generate_dataset(args.data, args.classes, args.images_per_class)
+
+    results = run_benchmark(args.data, epochs=args.epochs, workers=args.workers, train=not args.skip_training)
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['regressions'] = compare_results(results, json.load(f), args.tolerance)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+
+    if not results['fast_decode_quality']['within_tolerance']:
+        print("Warning: The fast decode path differs from the standard path by more than the tolerance.")
+    if results.get('regressions'):
+        print("Throughput regressions against the baseline:")
+        for regression in results['regressions']:
+            print(f"- {regression['name']}: {regression['baseline_items_per_sec']} -> "
+                  f"{regression['items_per_sec']} items/s ({regression['change'] * 100:.1f}%)")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
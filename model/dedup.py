@@ -0,0 +1,132 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+# --- Configuration ---
+HASH_SIZE = 8 # dHash grid: HASH_SIZE x HASH_SIZE comparisons give a 64-bit hash
+MAX_DISTANCE = 4 # Hashes this many bits apart (or fewer) count as near-duplicates
+MIN_HASH_BITS = 8 # Hashes with fewer 1 (or 0) bits come from flat or low-texture crops and never match
+PREDICTION_CACHE_SIZE = 4096 # Entries kept by the inference server's prediction cache
+
+def perceptual_hash(img_array, hash_size=HASH_SIZE):
+    """
+    Returns the difference hash (dHash) of a uint8 RGB crop as an int: the crop is shrunk to a
+    (hash_size + 1) x hash_size grayscale grid and each bit records whether a pixel's right-hand
+    neighbour is brighter than the pixel itself. Re-encoding, resizing and small exposure changes leave the hash (nearly) unchanged.
+    """
+    gray = Image.fromarray(np.asarray(img_array, dtype=np.uint8)).convert('L')
+    pixels = np.asarray(gray.resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+def hamming_distance(hash_a, hash_b):
+    return (hash_a ^ hash_b).bit_count()
+
+def upload_digest(image_bytes, bbox=None):
+    """Returns an exact digest of uploaded file bytes and the requested bbox, usable before anything is decoded."""
+    digest = hashlib.blake2b(str(bbox).encode(), digest_size=16)
+    digest.update(image_bytes)
+    return 'upload:' + digest.hexdigest()
+
+def crop_digest(img_array):
+    """Returns an exact digest of a crop's pixels and shape, for caches that must not confuse different images."""
+    img_array = np.ascontiguousarray(img_array)
+    digest = hashlib.blake2b(str(img_array.shape).encode(), digest_size=16)
+    digest.update(img_array.tobytes())
+    return 'crop:' + digest.hexdigest()
+
+class HashIndex:
+    """
+    Finds stored hashes within max_distance bits of a query without comparing against every entry.
+    Hashes are split into max_distance + 1 bands; two hashes that differ in at most max_distance bits
+    must agree exactly on at least one band, so only entries sharing a band are compared.
+    Low-entropy hashes (fewer than min_bits 1 or 0 bits, e.g. every flat crop hashes to 0) are neither stored nor matched.
+    """
+
+    def __init__(self, max_distance=MAX_DISTANCE, hash_bits=HASH_SIZE * HASH_SIZE, min_bits=MIN_HASH_BITS):
+        self.max_distance = max_distance
+        self.hash_bits = hash_bits
+        self.min_bits = min_bits
+        num_bands = max_distance + 1
+        band_width = -(-hash_bits // num_bands) # Ceiling division
+        self.bands = [(start, (1 << min(band_width, hash_bits - start)) - 1) for start in range(0, hash_bits, band_width)]
+        self.band_tables = [{} for _ in self.bands]
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_informative(self, image_hash):
+        ones = image_hash.bit_count()
+        return self.min_bits <= ones <= self.hash_bits - self.min_bits
+
+    def find(self, image_hash):
+        """Returns (value, distance) for the closest stored hash within max_distance, or None."""
+        if not self.is_informative(image_hash):
+            return None
+        best = None
+        seen = set()
+        for (start, mask), table in zip(self.bands, self.band_tables):
+            for entry_id in table.get((image_hash >> start) & mask, ()):
+                if entry_id in seen:
+                    continue
+                seen.add(entry_id)
+                stored_hash, value = self.entries[entry_id]
+                distance = hamming_distance(image_hash, stored_hash)
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (value, distance)
+        return best
+
+    def add(self, image_hash, value):
+        if not self.is_informative(image_hash):
+            return
+        entry_id = len(self.entries)
+        self.entries.append((image_hash, value))
+        for (start, mask), table in zip(self.bands, self.band_tables):
+            table.setdefault((image_hash >> start) & mask, []).append(entry_id)
+
+class PredictionCache:
+    """
+    Bounded, thread-safe LRU cache of prediction results keyed by upload_digest and crop_digest.
+    Counts hits and misses per lookup; the least recently used entry is evicted when max_size is reached.
+    """
+
+    def __init__(self, max_size=PREDICTION_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock() # The inference server handles requests on several threads
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached result for key (marking it recently used), or None."""
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, result):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
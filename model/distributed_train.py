@@ -0,0 +1,290 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+import keras
+from keras.callbacks import EarlyStopping, ModelCheckpoint
+from sklearn.model_selection import train_test_split
+import model as pipeline
+from instrumentation import metrics, ThroughputCallback
+
+# --- Configuration ---
+NUM_LOCAL_WORKERS = 2 # Worker processes started by the single-host launcher (e.g. one per CPU socket)
+PER_WORKER_BATCH_SIZE = pipeline.BATCH_SIZE # The global batch size is this times the number of workers
+BASE_LEARNING_RATE = pipeline.LEARNING_RATE # Learning rate for one worker; scaled linearly with the worker count
+SCALE_LEARNING_RATE = True
+WORKER_LOG_DIR = 'worker_logs' # Output of non-chief local workers; the chief prints to the console
+
+def distributed_datasets(strategy, img_paths, xml_paths, label_indices, num_classes, global_batch_size, shuffle=False):
+    """
+    Builds a per-worker streaming pipeline through strategy.distribute_datasets_from_function.
+    Each worker decodes only its own shard of the file list and batches global_batch_size / workers images.
+    """
+    def dataset_fn(input_context):
+        shard = slice(input_context.input_pipeline_id, None, input_context.num_input_pipelines)
+        ds = pipeline.make_streaming_dataset(img_paths[shard], xml_paths[shard], label_indices[shard], num_classes,
+                                             batch_size=input_context.get_per_replica_batch_size(global_batch_size),
+                                             shuffle=shuffle)
+        # Shards differ in size (and in skipped images), so repeat and let steps_per_epoch keep the workers in lockstep
+        return ds.repeat()
+    return strategy.distribute_datasets_from_function(dataset_fn)
+
+def distributed_eval_dataset(strategy, img_paths, xml_paths, label_indices, num_classes, global_batch_size):
+    """
+    Builds a finite per-worker (image, one-hot label, weight) pipeline for evaluation.
+    Shards are padded to the same length, so every worker yields the same number of batches per pass;
+    padding rows and skipped images get weight 0, so one pass counts every usable image exactly once.
+    """
+    def dataset_fn(input_context):
+        num_shards = input_context.num_input_pipelines
+        shard_size = -(-len(img_paths) // num_shards) # Ceiling division
+        shard = slice(input_context.input_pipeline_id, None, num_shards)
+        padding = shard_size - len(img_paths[shard])
+        # Padding repeats the shard's first images; their weight of 0 keeps them out of the totals
+        shard_img_paths = np.concatenate([img_paths[shard], img_paths[shard][:padding]])
+        shard_xml_paths = np.concatenate([xml_paths[shard], xml_paths[shard][:padding]])
+        shard_labels = np.concatenate([label_indices[shard], label_indices[shard][:padding]]).astype(np.int32)
+        counted = np.arange(shard_size) < shard_size - padding
+        ds = tf.data.Dataset.from_tensor_slices((list(shard_img_paths), list(shard_xml_paths), shard_labels, counted))
+        ds = ds.map(
+            lambda img_path, xml_path, label, counted: pipeline._load_annotated_image_tf(img_path, xml_path, label) + (counted,),
+            num_parallel_calls=tf.data.AUTOTUNE)
+        ds = ds.map(
+            lambda image, label, ok, counted: (
+                tf.keras.applications.mobilenet_v2.preprocess_input(tf.cast(image, tf.float32)),
+                tf.one_hot(label, num_classes),
+                tf.cast(tf.logical_and(ok, counted), tf.float32),
+            ),
+            num_parallel_calls=tf.data.AUTOTUNE,
+        )
+        return ds.batch(input_context.get_per_replica_batch_size(global_batch_size)).prefetch(tf.data.AUTOTUNE)
+    return strategy.distribute_datasets_from_function(dataset_fn)
+
+def train_worker(data_dir=pipeline.IMAGE_DIR, per_worker_batch_size=PER_WORKER_BATCH_SIZE, epochs=pipeline.EPOCHS,
+                 scale_learning_rate=SCALE_LEARNING_RATE, threads=None):
+    """
+    Runs one worker of a MultiWorkerMirroredStrategy job described by the TF_CONFIG environment variable.
+    Every worker builds the same split and model; only the chief writes checkpoints, the final model,
+    class names and metrics.
+    """
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+    # The strategy has to be created before any other TensorFlow op runs in this process
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    num_workers = strategy.num_replicas_in_sync
+    is_chief = strategy.extended.should_checkpoint
+    global_batch_size = per_worker_batch_size * num_workers
+    learning_rate = BASE_LEARNING_RATE * num_workers if scale_learning_rate else BASE_LEARNING_RATE
+    metrics.reset()
+    print(f"Worker {strategy.cluster_resolver.task_id} of {num_workers}{' (chief)' if is_chief else ''}: "
+          f"global batch size {global_batch_size}, learning rate {learning_rate}")
+
+    class_names, samples = pipeline.list_dataset_samples(data_dir)
+    if not samples:
+        print("No data was found. Please check the data directory and its structure. Exiting.")
+        return
+    samples.sort() # Every worker must see the same order, whatever order its file system lists files in
+    img_paths, xml_paths, label_indices = (np.array(column) for column in zip(*samples))
+    num_classes = len(class_names)
+    train_idx, val_idx = train_test_split(
+        np.arange(len(img_paths)),
+        test_size=pipeline.VALIDATION_SPLIT,
+        random_state=42,
+        stratify=label_indices if num_classes > 1 else None
+    )
+    if len(train_idx) < num_workers or 0 < len(val_idx) < num_workers:
+        print(f"Error: Every one of the {num_workers} workers needs at least one training and validation image. Exiting.")
+        return
+    print(f"Training samples: {len(train_idx)}, Validation samples: {len(val_idx)}")
+
+    train_ds = distributed_datasets(strategy, img_paths[train_idx], xml_paths[train_idx], label_indices[train_idx],
+                                    num_classes, global_batch_size, shuffle=True)
+    steps_per_epoch = max(1, len(train_idx) // global_batch_size)
+    val_ds, validation_steps = None, None
+    if len(val_idx) > 0:
+        val_ds = distributed_eval_dataset(strategy, img_paths[val_idx], xml_paths[val_idx], label_indices[val_idx],
+                                          num_classes, global_batch_size)
+        validation_steps = int(np.ceil(np.ceil(len(val_idx) / num_workers) / per_worker_batch_size))
+
+    with strategy.scope():
+        model = pipeline.build_model(num_classes=num_classes, input_shape=(pipeline.IMG_HEIGHT, pipeline.IMG_WIDTH, 3),
+                                     learning_rate=learning_rate)
+    train_step, test_step = make_step_functions(strategy, model)
+
+    # val_loss is all-reduced, so every worker makes the same early-stopping decision
+    callbacks_list = []
+    if val_ds is not None:
+        callbacks_list.append(EarlyStopping(monitor='val_loss', patience=pipeline.EARLY_STOPPING_PATIENCE, verbose=1 if is_chief else 0,
+                                            restore_best_weights=True))
+        if is_chief:
+            callbacks_list.append(ModelCheckpoint(filepath=pipeline.MODEL_CHECKPOINT_PATH, monitor='val_loss',
+                                                  save_best_only=True, verbose=1))
+    callbacks_list.append(ThroughputCallback(global_batch_size, verbose=1 if is_chief else 0))
+    callbacks = keras.callbacks.CallbackList(callbacks_list, model=model, epochs=epochs, steps=steps_per_epoch)
+
+    # Keras 3's model.fit cannot start with more than one MultiWorkerMirroredStrategy worker (its first-batch build
+    # reduces the whole (x, y) batch at once), so this loop runs the steps and drives the usual callbacks itself
+    train_iterator = iter(train_ds)
+    model.stop_training = False
+    with metrics.timed('fit'):
+        callbacks.on_train_begin()
+        for epoch in range(epochs):
+            callbacks.on_epoch_begin(epoch)
+            totals = np.zeros(3)
+            for step in range(steps_per_epoch):
+                callbacks.on_train_batch_begin(step)
+                totals += train_step(train_iterator).numpy()
+                callbacks.on_train_batch_end(step)
+            logs = {'loss': totals[0] / totals[2], 'accuracy': totals[1] / totals[2]}
+            if val_ds is not None:
+                logs.update(run_evaluation(test_step, val_ds, validation_steps, prefix='val_'))
+            if is_chief:
+                print(f"Epoch {epoch + 1}/{epochs} - " + ' - '.join(f"{name}: {value:.4f}" for name, value in logs.items()))
+            callbacks.on_epoch_end(epoch, logs)
+            if model.stop_training:
+                break
+        callbacks.on_train_end()
+
+    if val_ds is not None:
+        # Evaluation runs collective ops, so every worker has to take part
+        results = run_evaluation(test_step, val_ds, validation_steps)
+        print(f"Validation Accuracy: {results['accuracy']*100:.2f}%")
+        print(f"Validation Loss: {results['loss']:.4f}")
+
+    if is_chief:
+        model.save('final_image_classifier_model.keras')
+        with open(pipeline.CLASS_NAMES_PATH, 'w') as f:
+            json.dump([str(name) for name in class_names], f)
+        metrics.write_json(pipeline.METRICS_LOG_PATH)
+        print(f"Final model, class names and metrics saved by the chief ({pipeline.CLASS_NAMES_PATH}, {pipeline.METRICS_LOG_PATH}).")
+
+def make_step_functions(strategy, model):
+    """
+    Returns (train_step, test_step) tf.functions that run one batch on every replica and return the
+    all-reduced [loss sum, correct predictions, examples] for it. Gradients are all-reduced by the optimizer.
+    """
+    def batch_totals(y, predictions, per_example_loss, weights=None):
+        correct = tf.cast(tf.equal(tf.argmax(y, axis=1), tf.argmax(predictions, axis=1)), tf.float32)
+        if weights is None:
+            return tf.stack([tf.reduce_sum(per_example_loss), tf.reduce_sum(correct), tf.cast(tf.shape(y)[0], tf.float32)])
+        return tf.stack([tf.reduce_sum(per_example_loss * weights), tf.reduce_sum(correct * weights), tf.reduce_sum(weights)])
+
+    def train_fn(x, y):
+        with tf.GradientTape() as tape:
+            predictions = model(x, training=True)
+            per_example_loss = keras.losses.categorical_crossentropy(y, predictions)
+            loss = tf.nn.compute_average_loss(per_example_loss)
+        gradients = tape.gradient(loss, model.trainable_variables)
+        model.optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        return batch_totals(y, predictions, per_example_loss)
+
+    def test_fn(x, y, weights):
+        predictions = model(x, training=False)
+        return batch_totals(y, predictions, keras.losses.categorical_crossentropy(y, predictions), weights)
+
+    @tf.function
+    def train_step(iterator):
+        return strategy.reduce('SUM', strategy.run(train_fn, args=next(iterator)), axis=None)
+
+    @tf.function
+    def test_step(iterator):
+        return strategy.reduce('SUM', strategy.run(test_fn, args=next(iterator)), axis=None)
+
+    return train_step, test_step
+
+def run_evaluation(test_step, dataset, steps, prefix=''):
+    """
+    Runs one full pass (steps batches per worker) over a distributed_eval_dataset from a fresh iterator
+    and returns {'<prefix>loss': ..., '<prefix>accuracy': ...} over all workers.
+    """
+    iterator = iter(dataset)
+    totals = np.zeros(3)
+    for _ in range(steps):
+        totals += test_step(iterator).numpy()
+    return {f'{prefix}loss': totals[0] / totals[2], f'{prefix}accuracy': totals[1] / totals[2]}
+
+def find_free_ports(count):
+    """Returns count currently unused TCP ports on localhost."""
+    sockets = [socket.socket() for _ in range(count)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+def launch_local_workers(num_workers=NUM_LOCAL_WORKERS, worker_args=(), log_dir=WORKER_LOG_DIR):
+    """
+    Starts num_workers copies of the running script on this host, each with its own TF_CONFIG, and waits for them.
+    Worker 0 is the chief and prints to the console; the others log to log_dir. If a worker fails, the rest
+    are stopped (they would otherwise wait for it forever). Returns the first non-zero exit code, or 0.
+    """
+    cluster = {'worker': [f'localhost:{port}' for port in find_free_ports(num_workers)]}
+    os.makedirs(log_dir, exist_ok=True)
+    processes, log_files = [], []
+    for index in range(num_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': index}}))
+        output = None
+        if index > 0:
+            output = open(os.path.join(log_dir, f'worker_{index}.log'), 'w')
+            log_files.append(output)
+        command = [sys.executable, os.path.abspath(sys.argv[0])] + list(worker_args)
+        processes.append(subprocess.Popen(command, env=env, stdout=output, stderr=subprocess.STDOUT if output else None))
+    print(f"Started {num_workers} local workers on {', '.join(cluster['worker'])} (logs of workers 1+ in '{log_dir}').")
+
+    exit_code = 0
+    try:
+        while any(process.poll() is None for process in processes):
+            failed = [process for process in processes if process.returncode not in (None, 0)]
+            if failed:
+                exit_code = failed[0].returncode
+                print(f"Error: A worker exited with code {exit_code}. Stopping the others.")
+                break
+            time.sleep(1)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired: # Blocked in a collective op waiting for a dead peer
+                process.kill()
+                process.wait()
+        for output in log_files:
+            output.close()
+    return exit_code or next((process.returncode for process in processes if process.returncode), 0)
+
+def main():
+    parser = argparse.ArgumentParser(description="Data-parallel CPU training with MultiWorkerMirroredStrategy.")
+    parser.add_argument('--data', default=pipeline.IMAGE_DIR, help="Dataset directory (class folders with images and VOC XMLs)")
+    parser.add_argument('--workers', type=int, default=NUM_LOCAL_WORKERS, help="Local worker processes to launch on this host")
+    parser.add_argument('--batch-size', type=int, default=PER_WORKER_BATCH_SIZE, help="Batch size per worker")
+    parser.add_argument('--epochs', type=int, default=pipeline.EPOCHS)
+    parser.add_argument('--no-lr-scaling', action='store_true', help="Keep the base learning rate regardless of the worker count")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="Intra-op threads per worker (local launcher default: CPU count / workers)")
+    parser.add_argument('--cluster-spec', help="JSON file like {\"worker\": [\"host1:port\", \"host2:port\"]} for multi-host runs")
+    parser.add_argument('--task-index', type=int, default=0, help="This host's index in the cluster spec's worker list")
+    args = parser.parse_args()
+
+    if args.cluster_spec:
+        with open(args.cluster_spec) as f:
+            cluster = json.load(f)
+        os.environ['TF_CONFIG'] = json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': args.task_index}})
+
+    if 'TF_CONFIG' in os.environ:
+        train_worker(args.data, args.batch_size, args.epochs, scale_learning_rate=not args.no_lr_scaling, threads=args.threads)
+        return
+
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    worker_args = ['--data', args.data, '--batch-size', str(args.batch_size), '--epochs', str(args.epochs),
+                   '--threads', str(threads)] + (['--no-lr-scaling'] if args.no_lr_scaling else [])
+    sys.exit(launch_local_workers(args.workers, worker_args))
+
+if __name__ == '__main__':
+    main()
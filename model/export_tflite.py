@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+import keras
+
+try:
+    from ai_edge_litert.interpreter import Interpreter # Standalone LiteRT runtime, as used on devices
+except ImportError:
+    Interpreter = tf.lite.Interpreter
+
+# --- Configuration ---
+TFLITE_VARIANTS = ('float32', 'dynamic_range', 'int8') # float32 is the unquantized baseline
+REPRESENTATIVE_SAMPLES = 200 # Training crops used to calibrate full-int8 quantization
+BENCHMARK_SAMPLES = 500 # Validation crops used for latency and agreement
+BENCHMARK_THREADS = 1 # Interpreter threads; low-end field devices usually give us one core
+OUTPUT_PREFIX = 'image_classifier' # Files are written as <prefix>_<variant>.tflite
+REPORT_PATH = 'tflite_benchmark.json'
+
+def iter_image_batches(data):
+    """
+    Yields preprocessed float32 image batches from any of the training data forms used by model.py:
+    an (x, y) tuple or {'x': ..., 'y': ...} dict of arrays, a tf.data dataset of (x, y), or a keras Sequence.
+    """
+    if isinstance(data, dict): # model.fit keyword arguments, as prepared by model.py
+        data = (data['x'], data['y']) if 'y' in data else data['x']
+    if isinstance(data, tuple):
+        x = data[0]
+        for start in range(0, len(x), 32):
+            yield np.asarray(x[start:start + 32], dtype=np.float32)
+    elif isinstance(data, tf.data.Dataset):
+        for x, _ in data.as_numpy_iterator():
+            yield x
+    else:
+        for i in range(len(data)):
+            yield data[i][0]
+
+def take_images(data, limit):
+    """Collects up to limit single images from iter_image_batches(data)."""
+    images = []
+    for batch in iter_image_batches(data):
+        images.extend(batch[:limit - len(images)])
+        if len(images) >= limit:
+            break
+    return np.array(images, dtype=np.float32)
+
+def convert_to_tflite(model, variant, representative_images=None):
+    """Converts a Keras model to a TFLite flatbuffer: 'float32', 'dynamic_range' or 'int8' (full integer, int8 in/out)."""
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if variant == 'dynamic_range':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif variant == 'int8':
+        if representative_images is None or len(representative_images) == 0:
+            raise ValueError("Full-int8 quantization needs representative images.")
+
+        def representative_dataset():
+            for image in representative_images:
+                yield [image[np.newaxis]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+    elif variant != 'float32':
+        raise ValueError(f"Unknown TFLite variant '{variant}'.")
+    return converter.convert()
+
+def run_tflite(model_content, images, num_threads=BENCHMARK_THREADS):
+    """
+    Runs a TFLite model one image at a time, as a device would.
+    Returns (probabilities, per-image latencies in ms). Quantized inputs/outputs are (de)quantized here.
+    """
+    interpreter = Interpreter(model_content=model_content, num_threads=num_threads)
+    interpreter.allocate_tensors()
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    input_scale, input_zero_point = input_details['quantization']
+    output_scale, output_zero_point = output_details['quantization']
+
+    outputs, latencies = [], []
+    for image in images:
+        x = image[np.newaxis]
+        if input_details['dtype'] != np.float32:
+            x = np.clip(np.round(x / input_scale + input_zero_point),
+                        np.iinfo(input_details['dtype']).min, np.iinfo(input_details['dtype']).max)
+        start = time.perf_counter()
+        interpreter.set_tensor(input_details['index'], x.astype(input_details['dtype']))
+        interpreter.invoke()
+        y = interpreter.get_tensor(output_details['index'])[0]
+        latencies.append((time.perf_counter() - start) * 1000)
+        if output_details['dtype'] != np.float32:
+            y = (y.astype(np.float32) - output_zero_point) * output_scale
+        outputs.append(y)
+    return np.array(outputs), np.array(latencies)
+
+def export_and_benchmark(model, train_data, val_data, output_prefix=OUTPUT_PREFIX, report_path=REPORT_PATH,
+                         variants=TFLITE_VARIANTS, num_threads=BENCHMARK_THREADS):
+    """
+    Writes one .tflite file per variant and benchmarks each on the validation images:
+    file size, per-image latency (mean/p50/p90) and top-1 agreement with the Keras float model.
+    Representative images for int8 calibration come from the training data. Returns the report rows.
+    """
+    representative_images = take_images(train_data, REPRESENTATIVE_SAMPLES)
+    benchmark_images = take_images(val_data if val_data is not None else train_data, BENCHMARK_SAMPLES)
+    if len(benchmark_images) == 0:
+        print("Warning: No images available for the TFLite benchmark. Skipping export.")
+        return []
+    reference_top1 = np.argmax(model.predict(benchmark_images, verbose=0), axis=1)
+
+    rows = []
+    for variant in variants:
+        model_content = convert_to_tflite(model, variant, representative_images)
+        output_path = f"{output_prefix}_{variant}.tflite"
+        with open(output_path, 'wb') as f:
+            f.write(model_content)
+        probabilities, latencies = run_tflite(model_content, benchmark_images, num_threads=num_threads)
+        rows.append({
+            'variant': variant,
+            'path': output_path,
+            'size_mb': round(os.path.getsize(output_path) / 1e6, 3),
+            'latency_ms_mean': round(float(np.mean(latencies)), 3),
+            'latency_ms_p50': round(float(np.percentile(latencies, 50)), 3),
+            'latency_ms_p90': round(float(np.percentile(latencies, 90)), 3),
+            'top1_agreement': round(float(np.mean(np.argmax(probabilities, axis=1) == reference_top1)), 4),
+            'num_images': int(len(benchmark_images)),
+            'num_threads': num_threads,
+        })
+
+    print(f"\n{'Variant':<15}{'Size (MB)':>10}{'Mean ms':>10}{'p90 ms':>10}{'Top-1 agree':>13}")
+    for row in rows:
+        print(f"{row['variant']:<15}{row['size_mb']:>10.2f}{row['latency_ms_mean']:>10.2f}"
+              f"{row['latency_ms_p90']:>10.2f}{row['top1_agreement'] * 100:>12.1f}%")
+    with open(report_path, 'w') as f:
+        json.dump(rows, f, indent=2)
+    print(f"TFLite benchmark report saved to {report_path}")
+    return rows
+
+def main():
+    # Imported here because model.py imports this module for its optional export step
+    from model import build_streaming_datasets, IMAGE_DIR, MODEL_CHECKPOINT_PATH
+
+    parser = argparse.ArgumentParser(description="Export a trained classifier to quantized TFLite models and benchmark them.")
+    parser.add_argument('--model', default=MODEL_CHECKPOINT_PATH, help="Path to the trained .keras model")
+    parser.add_argument('--data', default=IMAGE_DIR, help="Dataset directory (class folders with images and VOC XMLs)")
+    parser.add_argument('--output-prefix', default=OUTPUT_PREFIX)
+    parser.add_argument('--report', default=REPORT_PATH)
+    parser.add_argument('--threads', type=int, default=BENCHMARK_THREADS)
+    args = parser.parse_args()
+
+    model = keras.models.load_model(args.model)
+    # Streaming datasets use the same seed and split fraction as training, without loading everything into RAM
+    train_ds, val_ds, _, _, _ = build_streaming_datasets(args.data)
+    if train_ds is None:
+        return
+    export_and_benchmark(model, train_ds, val_ds, output_prefix=args.output_prefix,
+                         report_path=args.report, num_threads=args.threads)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+
+# --- Configuration ---
+OUTPUT_DIR = 'synthetic_dir'
+NUM_CLASSES = 4
+IMAGES_PER_CLASS = 250
+MIN_SIZE = (640, 480) # Smallest (width, height) of a generated image
+MAX_SIZE = (1600, 1200) # Largest (width, height) of a generated image
+SEED = 42
+CHUNK_SIZE = 25 # Images generated per worker task
+
+VOC_TEMPLATE = '''<annotation>
+    <folder>{folder}</folder>
+    <filename>{filename}</filename>
+    <path>{path}</path>
+    <source><database>Synthetic</database></source>
+    <size><width>{width}</width><height>{height}</height><depth>3</depth></size>
+    <segmented>0</segmented>
+    <object>
+        <name>{folder}</name>
+        <pose>Unspecified</pose>
+        <truncated>0</truncated>
+        <difficult>0</difficult>
+        <bndbox><xmin>{xmin}</xmin><ymin>{ymin}</ymin><xmax>{xmax}</xmax><ymax>{ymax}</ymax></bndbox>
+    </object>
+</annotation>'''
+
+def make_image(rng, width, height):
+    """
+    Draws a noisy gradient image. The noise keeps JPEG files (and decode cost) close to real photos,
+    unlike solid colours, which compress to almost nothing.
+    """
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None, None]
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    base = (x * rng.uniform(0.2, 1.0, 3) + y * rng.uniform(0.2, 1.0, 3)) / 2
+    noise = rng.normal(0, 24, (height, width, 3))
+    return Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8))
+
+def generate_dataset(output_dir=OUTPUT_DIR, num_classes=NUM_CLASSES, images_per_class=IMAGES_PER_CLASS,
+                     min_size=MIN_SIZE, max_size=MAX_SIZE, seed=SEED, workers=None):
+    """
+    Generates num_classes x images_per_class annotated images in the layout model.py expects
+    (output_dir/class_XXX/imgNNNNNN.jpg + .xml), splitting the work across processes.
+    Output is deterministic for a given seed regardless of the worker count.
+    """
+    # Fixed-size chunks (each with its own seed) keep the output independent of the worker count
+    # while still spreading a few large classes over every worker
+    jobs = []
+    for class_index in range(num_classes):
+        for chunk_index, start in enumerate(range(0, images_per_class, CHUNK_SIZE)):
+            jobs.append((class_index, chunk_index, start, min(CHUNK_SIZE, images_per_class - start)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_generate_chunk, output_dir, class_index, start, count, min_size, max_size,
+                                   [seed, class_index, chunk_index])
+                   for class_index, chunk_index, start, count in jobs]
+        total = sum(future.result() for future in futures)
+    print(f"Generated {total} images in {num_classes} classes under '{output_dir}'.")
+    return total
+
+def _generate_chunk(output_dir, class_index, start, count, min_size, max_size, seed):
+    """Writes images start..start+count-1 of one class (file names are offset by start)."""
+    rng = np.random.default_rng(seed)
+    class_name = f"class_{class_index:03d}"
+    class_path = os.path.join(output_dir, class_name)
+    os.makedirs(class_path, exist_ok=True)
+    for i in range(start, start + count):
+        width = int(rng.integers(min_size[0], max_size[0] + 1))
+        height = int(rng.integers(min_size[1], max_size[1] + 1))
+        # Boxes cover 30-95% of each side, like a cow filling much of a phone photo
+        box_width = int(width * rng.uniform(0.3, 0.95))
+        box_height = int(height * rng.uniform(0.3, 0.95))
+        xmin = int(rng.integers(0, width - box_width + 1))
+        ymin = int(rng.integers(0, height - box_height + 1))
+
+        img_filename = f"img{i:06d}.jpg"
+        make_image(rng, width, height).save(os.path.join(class_path, img_filename), quality=90)
+        xml_content = VOC_TEMPLATE.format(folder=class_name, filename=img_filename,
+                                          path=os.path.join(class_path, img_filename),
+                                          width=width, height=height,
+                                          xmin=xmin, ymin=ymin, xmax=xmin + box_width, ymax=ymin + box_height)
+        with open(os.path.join(class_path, f"img{i:06d}.xml"), 'w') as f:
+            f.write(xml_content)
+    return count
+
+def parse_size(value):
+    """Parses 'WIDTHxHEIGHT' into a (width, height) tuple."""
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic annotated dataset in the layout model.py expects.")
+    parser.add_argument('--output', default=OUTPUT_DIR)
+    parser.add_argument('--classes', type=int, default=NUM_CLASSES)
+    parser.add_argument('--images-per-class', type=int, default=IMAGES_PER_CLASS)
+    parser.add_argument('--min-size', type=parse_size, default=MIN_SIZE, help="Smallest image size, e.g. 640x480")
+    parser.add_argument('--max-size', type=parse_size, default=MAX_SIZE, help="Largest image size, e.g. 4000x3000")
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    args = parser.parse_args()
+    generate_dataset(args.output, args.classes, args.images_per_class, args.min_size, args.max_size,
+                     args.seed, args.workers)
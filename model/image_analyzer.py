@@ -1,7 +1,112 @@
-from PIL import Image
-from PIL.ExifTags import TAGS
+from PIL import Image, TiffImagePlugin
+from PIL.ExifTags import TAGS, IFD
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import glob
+import json
+import os
 import sys
 
+# EXIF tags kept in the printed report and in batch records
+SELECTED_EXIF_TAGS = ['Make', 'Model', 'DateTime', 'Software', 'LensMake', 'LensModel', 'FNumber', 'ExposureTime', 'ISOSpeedRatings']
+# Image layout tags (size, strips, compression, resolution, ...) that TIFF keeps in the same IFD as EXIF metadata
+TIFF_STRUCTURE_TAGS = {256, 257, 258, 259, 262, 266, 273, 277, 278, 279, 282, 283, 284, 296, 317, 322, 323, 324, 325, 338, 339}
+# File types picked up when a directory is given in batch mode
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp', '.heic', '.heif')
+
+def _json_safe(value):
+    """Converts EXIF values (rationals, bytes, tuples) into JSON-serialisable types."""
+    if isinstance(value, TiffImagePlugin.IFDRational):
+        return float(value) if value.denominator else None
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace').rstrip('\x00')
+    if isinstance(value, (tuple, list)):
+        return [_json_safe(v) for v in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+def _read_exif(img):
+    """
+    Returns the EXIF tags of an opened image (IFD0 merged with the Exif sub-IFD) as a dict, or None,
+    without decoding pixels. Pillow's PNG plugin loads the whole image to look for an eXIf chunk after
+    the image data, so for PNG only an eXIf chunk already seen while reading the header is used.
+    """
+    if img.format == 'PNG' and 'exif' not in img.info:
+        return None
+    exif = img.getexif()
+    exif_data = dict(exif)
+    if img.format == 'TIFF':
+        exif_data = {tag: value for tag, value in exif_data.items() if tag not in TIFF_STRUCTURE_TAGS}
+    exif_data.update(exif.get_ifd(IFD.Exif))
+    return exif_data or None
+
+def collect_image_info(img):
+    """
+    Collects basic information and depth indicators from an opened image.
+    Only the header and metadata are read; pixel data is never decoded.
+
+    Args:
+        img (PIL.Image.Image): An image returned by Image.open.
+
+    Returns:
+        dict: format, width, height, mode, has_exif, selected EXIF tags, info_keys,
+        depth_indicators (bool) and depth_details (list of str).
+    """
+    has_depth_info = False
+    depth_info_details = []
+    selected_exif = {}
+
+    # 1. Check EXIF data for depth-related tags
+    exif_data = _read_exif(img)
+    if exif_data:
+        exif_readable = {TAGS.get(key, key): value for key, value in exif_data.items()}
+        for tag, value in exif_readable.items():
+            # Keep some common/interesting tags
+            if tag in SELECTED_EXIF_TAGS:
+                selected_exif[tag] = value
+
+            if isinstance(tag, str) and "depth" in tag.lower():
+                has_depth_info = True
+                depth_info_details.append(f"EXIF tag '{tag}' found: {value}")
+
+            if tag == 'SubjectDistanceRange': # Indicates distance to subject (not exactly depth map)
+                # This tag gives a general idea but isn't a depth map itself.
+                # Value 0: unknown, 1: macro, 2: close view, 3: distant view
+                depth_info_details.append(f"EXIF 'SubjectDistanceRange' found: {value} (0=unknown, 1=macro, 2=close, 3=distant)")
+
+    # 2. Check img.info dictionary (might contain format-specific metadata)
+    for key in img.info:
+        if isinstance(key, str) and "depth" in key.lower():
+            has_depth_info = True
+            depth_info_details.append(f"Image.info key '{key}' found.")
+        # Example for some PNGs storing depth in a specific chunk
+        if isinstance(key, str) and key.lower() in ('depth_map', 'disparity_map'):
+            has_depth_info = True
+            depth_info_details.append(f"Image.info key '{key}' found, indicating potential depth data.")
+
+    # 3. For formats like HEIC/HEIF, depth maps can be stored as auxiliary images.
+    # Pillow's handling of this can vary. More advanced parsing might be needed.
+    if img.format in ["HEIF", "HEIC"]:
+        # This is a placeholder. Accessing auxiliary images (like depth maps) in HEIF
+        # might require iterating through frames if `img.is_animated` or `img.n_frames > 1`,
+        # or checking specific properties. Pillow's support for HEIF metadata can be limited
+        # without specific plugins (like pillow-heif).
+        # For now, we'll just note it.
+        depth_info_details.append(f"Image is {img.format} format, which can contain depth maps as auxiliary images. Advanced parsing might be needed.")
+
+    return {
+        'format': img.format,
+        'width': img.size[0],
+        'height': img.size[1],
+        'mode': img.mode,
+        'has_exif': bool(exif_data),
+        'exif': selected_exif,
+        'info_keys': [str(key) for key in img.info],
+        'depth_indicators': has_depth_info,
+        'depth_details': depth_info_details,
+    }
+
 def analyze_image_depth_and_info(image_path):
     """
     Analyzes an image to find whether it likely has depth information
@@ -23,75 +128,29 @@ def analyze_image_depth_and_info(image_path):
         print(f"Size (Width x Height): {img.size[0]} x {img.size[1]}")
         print(f"Mode: {img.mode}")  # e.g., RGB, RGBA, L (grayscale)
 
-        has_depth_info = False
-        depth_info_details = []
-
-        # 1. Check EXIF data for depth-related tags
-        exif_data = img._getexif()
-        if exif_data:
-            print("\n--- EXIF Data ---")
-            exif_readable = {TAGS.get(key, key): value for key, value in exif_data.items()}
-            found_exif_data = False
-            for tag, value in exif_readable.items():
-                found_exif_data = True
-                # Print some common/interesting tags
-                if tag in ['Make', 'Model', 'DateTime', 'Software', 'LensMake', 'LensModel', 'FNumber', 'ExposureTime', 'ISOSpeedRatings']:
-                    print(f"{tag}: {value}")
-                
-                if isinstance(tag, str) and "depth" in tag.lower():
-                    has_depth_info = True
-                    depth_info_details.append(f"EXIF tag '{tag}' found: {value}")
-                
-                if tag == 'SubjectDistanceRange': # Indicates distance to subject (not exactly depth map)
-                    # This tag gives a general idea but isn't a depth map itself.
-                    # Value 0: unknown, 1: macro, 2: close view, 3: distant view
-                    depth_info_details.append(f"EXIF 'SubjectDistanceRange' found: {value} (0=unknown, 1=macro, 2=close, 3=distant)")
-                elif tag == 0xA431: # Tag for 'SerialNumber' often, but check if some devices use similar custom tags for depth info
-                    pass # Example of checking a specific numeric tag if known
-            
-            if not found_exif_data:
-                print("No standard EXIF tags found or decoded.")
+        info = collect_image_info(img)
+
+        print("\n--- EXIF Data ---")
+        if info['has_exif']:
+            for tag, value in info['exif'].items():
+                print(f"{tag}: {value}")
         else:
-            print("\n--- EXIF Data ---")
             print("No EXIF data found in this image.")
 
-        # 2. Check img.info dictionary (might contain format-specific metadata)
-        if img.info:
-            print("\n--- Image Info Dictionary (Metadata) ---")
-            for key, value in img.info.items():
-                # print(f"Info Key: {key}, Value: {str(value)[:100]}") # Print all for inspection
-                if isinstance(key, str) and "depth" in key.lower():
-                    has_depth_info = True
-                    depth_info_details.append(f"Image.info key '{key}' found.")
-                # Example for some PNGs storing depth in a specific chunk
-                if key.lower() == 'depth_map' or key.lower() == 'disparity_map':
-                    has_depth_info = True
-                    depth_info_details.append(f"Image.info key '{key}' found, indicating potential depth data.")
-        else:
-            print("\n--- Image Info Dictionary (Metadata) ---")
+        print("\n--- Image Info Dictionary (Metadata) ---")
+        if not info['info_keys']:
             print("No additional info dictionary found in this image.")
 
-        # 3. For formats like HEIC/HEIF, depth maps can be stored as auxiliary images.
-        # Pillow's handling of this can vary. More advanced parsing might be needed.
-        if img.format in ["HEIF", "HEIC"]:
-            # This is a placeholder. Accessing auxiliary images (like depth maps) in HEIF
-            # might require iterating through frames if `img.is_animated` or `img.n_frames > 1`,
-            # or checking specific properties. Pillow's support for HEIF metadata can be limited
-            # without specific plugins (like pillow-heif).
-            # For now, we'll just note it.
-            depth_info_details.append(f"Image is {img.format} format, which can contain depth maps as auxiliary images. Advanced parsing might be needed.")
-
-
         # Conclusion on Depth Information
         print("\n--- Depth Information Summary ---")
-        if has_depth_info:
+        if info['depth_indicators']:
             print("Depth information is LIKELY PRESENT based on the following indicators:")
-            for detail in depth_info_details:
+            for detail in info['depth_details']:
                 print(f"- {detail}")
         else:
             print("No direct indicators of depth information were found with basic checks.")
-            if depth_info_details: # Print any heuristic notes
-                 for detail in depth_info_details:
+            if info['depth_details']: # Print any heuristic notes
+                 for detail in info['depth_details']:
                     print(f"- Note: {detail}")
             print("Depth information can be stored in proprietary ways not covered by this script (e.g., within specific MakerNotes in EXIF, or as separate files/streams).")
 
@@ -104,12 +163,107 @@ def analyze_image_depth_and_info(image_path):
         if 'img' in locals() and hasattr(img, 'close'):
             img.close()
 
+def analyze_image_record(image_path):
+    """
+    Batch-mode worker: returns a JSON-serialisable record for one file.
+    Failures are reported in the record's 'error' field instead of raising.
+    """
+    record = {'path': image_path}
+    try:
+        stat = os.stat(image_path)
+        record['mtime_ns'] = stat.st_mtime_ns
+        record['file_size'] = stat.st_size
+        with Image.open(image_path) as img:
+            info = collect_image_info(img)
+        info['exif'] = {tag: _json_safe(value) for tag, value in info['exif'].items()}
+        record.update(info)
+        record['error'] = None
+    except Exception as e:
+        record['error'] = f"{type(e).__name__}: {e}"
+    return record
+
+def expand_inputs(inputs):
+    """Expands directories (recursively) and glob patterns into a sorted list of image file paths."""
+    paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                paths.update(os.path.join(root, name) for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(paths)
+
+def load_previous_records(output_path):
+    """Reads an earlier batch output as {path: record}. Records that failed are not kept, so they are retried."""
+    records = {}
+    if not os.path.exists(output_path):
+        return records
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('error') is None and 'path' in record:
+                records[record['path']] = record
+    return records
+
+def analyze_batch(inputs, output_path, workers=None, incremental=True, chunksize=64):
+    """
+    Analyzes every image matched by inputs across a process pool and writes one JSON record per line to output_path.
+    With incremental=True, files whose mtime and size match a record in the existing output are not opened again;
+    their old records are carried over. Returns (analyzed, reused) counts.
+    """
+    paths = expand_inputs(inputs)
+    previous = load_previous_records(output_path) if incremental else {}
+
+    reused, pending = [], []
+    for path in paths:
+        record = previous.get(path)
+        if record is not None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is not None and record.get('mtime_ns') == stat.st_mtime_ns and record.get('file_size') == stat.st_size:
+                reused.append(record)
+                continue
+        pending.append(path)
+
+    print(f"Found {len(paths)} image files: {len(reused)} unchanged since the last run, {len(pending)} to analyze.")
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for record in reused:
+            f.write(json.dumps(record) + '\n')
+        if pending:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for record in executor.map(analyze_image_record, pending, chunksize=chunksize):
+                    f.write(json.dumps(record) + '\n')
+    os.replace(tmp_path, output_path)
+
+    print(f"Wrote {len(paths)} records to '{output_path}'.")
+    return len(pending), len(reused)
+
+def run_batch_cli(argv):
+    parser = argparse.ArgumentParser(
+        prog="python image_analyzer.py --batch",
+        description="Screen folders of images for metadata and depth indicators (headers only, no pixel decode).")
+    parser.add_argument('inputs', nargs='+', help="Image files, directories (searched recursively) or glob patterns")
+    parser.add_argument('-o', '--output', default='image_metadata.jsonl', help="JSON Lines output file")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--full', action='store_true', help="Re-analyze every file instead of skipping unchanged ones")
+    args = parser.parse_args(argv)
+    analyze_batch(args.inputs, args.output, workers=args.workers, incremental=not args.full)
+
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 1 and sys.argv[1] == '--batch':
+        run_batch_cli(sys.argv[2:])
+    elif len(sys.argv) > 1:
         image_path_to_test = sys.argv[1]
         analyze_image_depth_and_info(image_path_to_test)
     else:
         print("Usage: python image_analyzer.py <path_to_image_file>")
+        print("       python image_analyzer.py --batch <dir|glob|file>... [-o records.jsonl] [-w workers] [--full]")
         # Example: Create a dummy image for a quick test if no path is given
         try:
             dummy_img = Image.new('RGB', (60, 30), color = 'blue')
@@ -117,4 +271,4 @@ if __name__ == "__main__":
             print("\nNo image path provided. Running analysis on a dummy 'dummy_test_image.png':")
             analyze_image_depth_and_info("dummy_test_image.png")
         except Exception as e:
-            print(f"Could not create or analyze dummy image: {e}")
\ No newline at end of file
+            print(f"Could not create or analyze dummy image: {e}")
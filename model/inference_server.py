@@ -0,0 +1,213 @@
+import io
+import json
+import queue
+import threading
+import time
+import argparse
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import tensorflow as tf
+import keras
+from model import crop_and_resize, MODEL_CHECKPOINT_PATH, CLASS_NAMES_PATH
+from dedup import upload_digest, crop_digest, PredictionCache, PREDICTION_CACHE_SIZE
+
+# --- Configuration ---
+HOST = '127.0.0.1'
+PORT = 8501
+MAX_BATCH_SIZE = 32 # Largest number of images sent to the model in one call
+MAX_WAIT_MS = 10 # How long the first request in a batch waits for others to join it
+REQUEST_QUEUE_SIZE = 128 # Listen backlog; socketserver's default of 5 resets connections when many uploads arrive at once
+
+def preprocess_image(image_bytes, bbox=None):
+    """
+    Turns uploaded image bytes into a model-ready uint8 array, using the same crop/resize as training.
+    bbox is (xmin, ymin, xmax, ymax) or None for the whole image.
+    """
+    return crop_and_resize(io.BytesIO(image_bytes), bbox)
+
+class MicroBatcher:
+    """
+    Groups concurrent predictions into batches.
+    A background thread takes the first queued image, waits up to max_wait_ms for more (stopping early
+    at max_batch_size), runs the model once on the whole batch and resolves each caller's Future.
+    """
+
+    def __init__(self, model, class_names, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.model = model
+        self.class_names = list(class_names)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.requests = queue.Queue()
+        self.batches_run = 0
+        self.images_predicted = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, img_array):
+        """Queues one preprocessed uint8 image. Returns a Future resolving to {class_name: probability}."""
+        future = Future()
+        self.requests.put((img_array, future))
+        return future
+
+    def predict(self, img_array):
+        """Blocking helper around submit()."""
+        return self.submit(img_array).result()
+
+    def _collect_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                images = np.stack([img_array for img_array, _ in batch]).astype(np.float32)
+                images = tf.keras.applications.mobilenet_v2.preprocess_input(images)
+                probabilities = np.asarray(self.model.predict_on_batch(images))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches_run += 1
+            self.images_predicted += len(batch)
+            for (_, future), row in zip(batch, probabilities):
+                future.set_result({name: float(p) for name, p in zip(self.class_names, row)})
+
+def load_classifier(model_path=MODEL_CHECKPOINT_PATH, class_names_path=CLASS_NAMES_PATH):
+    """Loads the trained model and the class names saved next to it by model.py."""
+    model = keras.models.load_model(model_path)
+    with open(class_names_path) as f:
+        class_names = json.load(f)
+    return model, class_names
+
+def parse_bbox(value):
+    """Parses 'xmin,ymin,xmax,ymax' from a query string, or returns None."""
+    if not value:
+        return None
+    xmin, ymin, xmax, ymax = (int(v) for v in value.split(','))
+    return xmin, ymin, xmax, ymax
+
+def make_handler(batcher, prediction_cache=None):
+    """
+    Builds the request handler class bound to a MicroBatcher.
+    With a PredictionCache, a repeat upload (same file bytes and bbox) is answered before it is decoded, and a
+    different file that decodes to the same crop pixels is answered without running the model.
+    """
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path == '/health':
+                self._send_json(200, {
+                    'status': 'ok',
+                    'classes': batcher.class_names,
+                    'batches_run': batcher.batches_run,
+                    'images_predicted': batcher.images_predicted,
+                    'prediction_cache': prediction_cache.stats() if prediction_cache is not None else None,
+                })
+            else:
+                self._send_json(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/predict':
+                self._send_json(404, {'error': 'Not found'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                image_bytes = self.rfile.read(length)
+                bbox = parse_bbox(parse_qs(url.query).get('bbox', [None])[0])
+            except Exception as e:
+                self._send_json(400, {'error': f"Could not read image: {e}"})
+                return
+            # Exact digests only: a perceptual hash ignores colour and maps every flat crop to the same key.
+            # The upload digest is checked first, so an identical re-upload skips decoding, cropping and resizing
+            upload_key = upload_digest(image_bytes, bbox) if prediction_cache is not None else None
+            probabilities = prediction_cache.get(upload_key) if prediction_cache is not None else None
+            cached = probabilities is not None
+            if not cached:
+                try:
+                    img_array = preprocess_image(image_bytes, bbox)
+                except Exception as e:
+                    self._send_json(400, {'error': f"Could not read image: {e}"})
+                    return
+                crop_key = crop_digest(img_array) if prediction_cache is not None else None
+                probabilities = prediction_cache.get(crop_key) if prediction_cache is not None else None
+                cached = probabilities is not None
+                if not cached:
+                    try:
+                        probabilities = batcher.predict(img_array)
+                    except Exception as e:
+                        self._send_json(500, {'error': f"Prediction failed: {e}"})
+                        return
+                    if prediction_cache is not None:
+                        prediction_cache.put(crop_key, probabilities)
+                if prediction_cache is not None:
+                    prediction_cache.put(upload_key, probabilities)
+            top_class = max(probabilities, key=probabilities.get)
+            self._send_json(200, {'predictions': probabilities, 'top_class': top_class, 'cached': cached})
+
+        def log_message(self, format, *args):
+            pass # Keep the console quiet under load; errors are returned to the client
+
+    return PredictionHandler
+
+def serve(model_path=MODEL_CHECKPOINT_PATH, class_names_path=CLASS_NAMES_PATH, host=HOST, port=PORT,
+          max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, cache_size=PREDICTION_CACHE_SIZE,
+          request_queue_size=REQUEST_QUEUE_SIZE):
+    """
+    Loads the model once and serves POST /predict (raw image body, optional ?bbox=xmin,ymin,xmax,ymax) and GET /health.
+    cache_size bounds the prediction cache for repeat uploads; 0 disables it. request_queue_size is the listen
+    backlog, i.e. how many connections may wait for the accept loop (the OS caps it at net.core.somaxconn).
+    """
+    model, class_names = load_classifier(model_path, class_names_path)
+    batcher = MicroBatcher(model, class_names, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    prediction_cache = PredictionCache(cache_size) if cache_size > 0 else None
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, prediction_cache), bind_and_activate=False)
+    server.request_queue_size = request_queue_size # Read by server_activate when it calls listen()
+    try:
+        server.server_bind()
+        server.server_activate()
+    except Exception:
+        server.server_close()
+        raise
+    print(f"Serving {model_path} on http://{host}:{port} (max batch {max_batch_size}, max wait {max_wait_ms} ms, "
+          f"prediction cache {cache_size} entries)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Batched HTTP inference server for the cow image classifier.")
+    parser.add_argument('--model', default=MODEL_CHECKPOINT_PATH, help="Path to the trained .keras model")
+    parser.add_argument('--class-names', default=CLASS_NAMES_PATH, help="Path to the class names JSON written by model.py")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS)
+    parser.add_argument('--cache-size', type=int, default=PREDICTION_CACHE_SIZE, help="Prediction cache entries (0 disables it)")
+    parser.add_argument('--request-queue-size', type=int, default=REQUEST_QUEUE_SIZE, help="Listen backlog for pending connections")
+    args = parser.parse_args()
+    serve(args.model, args.class_names, args.host, args.port, args.max_batch_size, args.max_wait_ms, args.cache_size,
+          args.request_queue_size)
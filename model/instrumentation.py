@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+import keras
+
+# Prefix for every Prometheus metric name written by write_prometheus
+METRIC_PREFIX = 'cow_classifier'
+
+class PipelineMetrics:
+    """
+    Accumulates wall time, item counts and bytes per pipeline stage, skip counts per reason,
+    and per-epoch training throughput. A module-level instance (`metrics`) is shared by model.py;
+    worker processes send their snapshot back so the parent can merge it.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # A fresh lock also keeps forked worker processes from inheriting one held by a parent thread
+        self.lock = threading.Lock() # tf.data map stages record from several threads
+        self.stages = {}
+        self.skips = {}
+        self.epochs = []
+        self.started_at = time.time()
+
+    def observe(self, stage, seconds, items=1, nbytes=0):
+        """Adds one measurement to a stage."""
+        with self.lock:
+            entry = self.stages.setdefault(stage, {'seconds': 0.0, 'items': 0, 'bytes': 0})
+            entry['seconds'] += seconds
+            entry['items'] += items
+            entry['bytes'] += nbytes
+
+    @contextlib.contextmanager
+    def timed(self, stage, items=1, nbytes=0):
+        """Times a block as one observation of stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, items, nbytes)
+
+    def count_skip(self, reason):
+        """Counts an image skipped for reason (e.g. 'missing_xml', 'no_object', 'bad_bbox', 'decode_error')."""
+        with self.lock:
+            self.skips[reason] = self.skips.get(reason, 0) + 1
+
+    def record_epoch(self, epoch_stats):
+        self.epochs.append(epoch_stats)
+
+    def snapshot(self):
+        """Returns the stage and skip counters in a picklable form for merge()."""
+        return {'stages': self.stages, 'skips': self.skips}
+
+    def merge(self, snapshot):
+        for stage, entry in snapshot['stages'].items():
+            self.observe(stage, entry['seconds'], entry['items'], entry['bytes'])
+        with self.lock:
+            for reason, count in snapshot['skips'].items():
+                self.skips[reason] = self.skips.get(reason, 0) + count
+
+    def to_dict(self):
+        stages = {}
+        for stage, entry in self.stages.items():
+            stages[stage] = dict(entry, items_per_sec=round(entry['items'] / entry['seconds'], 2) if entry['seconds'] > 0 else None)
+        return {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started_at)),
+            'duration_seconds': round(time.time() - self.started_at, 3),
+            'stages': stages,
+            'skips': dict(self.skips),
+            'skipped_total': sum(self.skips.values()),
+            'epochs': self.epochs,
+        }
+
+    def write_json(self, path):
+        """Appends this run as one JSON line to path, so the file keeps a history of runs."""
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.to_dict()) + '\n')
+
+    def write_prometheus(self, path):
+        """Writes the metrics in the Prometheus text exposition format (for the node_exporter textfile collector)."""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{METRIC_PREFIX}_{name}{{{label_text}}} {value}" if label_text else f"{METRIC_PREFIX}_{name} {value}")
+
+        metric('stage_seconds', 'gauge', "Wall time spent in each pipeline stage during the last run.",
+               [({'stage': s}, round(e['seconds'], 6)) for s, e in self.stages.items()])
+        metric('stage_items', 'gauge', "Items processed by each pipeline stage during the last run.",
+               [({'stage': s}, e['items']) for s, e in self.stages.items()])
+        metric('stage_bytes', 'gauge', "Bytes processed by each pipeline stage during the last run.",
+               [({'stage': s}, e['bytes']) for s, e in self.stages.items()])
+        metric('skipped_images', 'gauge', "Images skipped during loading, by reason.",
+               [({'reason': r}, c) for r, c in self.skips.items()])
+        if self.epochs:
+            last = self.epochs[-1]
+            metric('train_images_per_second', 'gauge', "Training throughput of the last epoch.",
+                   [({}, round(last['images_per_sec'], 3))])
+            metric('train_step_seconds', 'gauge', "Training step time percentiles of the last epoch.",
+                   [({'quantile': q}, round(last[f'step_seconds_p{int(float(q) * 100)}'], 6)) for q in ('0.5', '0.9', '0.99')])
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+metrics = PipelineMetrics()
+
+class ThroughputCallback(keras.callbacks.Callback):
+    """
+    Records images/sec and step-time percentiles (p50/p90/p99) for every training epoch into a PipelineMetrics.
+    Images per epoch are num_images when known, otherwise steps x batch_size (which overcounts a partial last batch).
+    """
+
+    def __init__(self, batch_size, num_images=None, pipeline_metrics=None, verbose=1):
+        super().__init__()
+        self.batch_size = batch_size
+        self.num_images = num_images
+        self.pipeline_metrics = pipeline_metrics or metrics
+        self.verbose = verbose
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+        self.train_end = self.epoch_start
+        self.step_times = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.train_end = time.perf_counter()
+        self.step_times.append(self.train_end - self.step_start)
+
+    def on_epoch_end(self, epoch, logs=None):
+        # Validation runs before on_epoch_end, so throughput uses the time up to the last training step
+        seconds = self.train_end - self.epoch_start
+        steps = len(self.step_times)
+        images = self.num_images if self.num_images is not None else steps * self.batch_size
+        step_times = np.array(self.step_times) if self.step_times else np.zeros(1)
+        stats = {
+            'epoch': epoch + 1,
+            'seconds': round(seconds, 4),
+            'steps': steps,
+            'images': images,
+            'images_per_sec': images / seconds if seconds > 0 else 0.0,
+            'step_seconds_p50': float(np.percentile(step_times, 50)),
+            'step_seconds_p90': float(np.percentile(step_times, 90)),
+            'step_seconds_p99': float(np.percentile(step_times, 99)),
+        }
+        self.pipeline_metrics.record_epoch(stats)
+        self.pipeline_metrics.observe('train_epoch', seconds, images)
+        if self.verbose:
+            print(f"\nEpoch {epoch + 1}: {stats['images_per_sec']:.1f} images/sec, step time "
+                  f"p50 {stats['step_seconds_p50'] * 1000:.1f} ms, p90 {stats['step_seconds_p90'] * 1000:.1f} ms, "
+                  f"p99 {stats['step_seconds_p99'] * 1000:.1f} ms")
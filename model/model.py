@@ -1,5 +1,11 @@
 import os
+import io
+import contextlib
+import hashlib
+import json
+import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 import numpy as np
 import tensorflow as tf
@@ -9,28 +15,613 @@ from keras.layers import Dense, GlobalAveragePooling2D, Dropout
 from keras.applications import MobileNetV2 # Using MobileNetV2 as an example
 # from tensorflow.keras.preprocessing.image import ImageDataGenerator # For on-the-fly augmentation
 from keras.optimizers import Adam
-from keras.callbacks import EarlyStopping, ModelCheckpoint # Added Callbacks
+from keras.callbacks import EarlyStopping, ModelCheckpoint, BackupAndRestore # Added Callbacks
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
+from instrumentation import metrics, ThroughputCallback
+from dedup import perceptual_hash, HashIndex
 
 # --- Configuration ---
 IMAGE_DIR = 'dir' # Main directory containing class folders (e.g., dir/folder1, dir/folder2)
 IMG_WIDTH, IMG_HEIGHT = 224, 224 # Target image size for the model input
 BATCH_SIZE = 32
+LEARNING_RATE = 0.001 # Adam learning rate
+DENSE_UNITS = 1024 # Width of the Dense layer in the classification head
+DROPOUT_RATE = 0.5 # Dropout after that layer
+EARLY_STOPPING_PATIENCE = 10 # Epochs without val_loss improvement before training stops
 EPOCHS = 100 # Number of times to iterate over the entire training dataset - Increased to 100
 VALIDATION_SPLIT = 0.2 # Percentage of data to use for validation (e.g., 0.2 means 20%)
 MODEL_CHECKPOINT_PATH = 'best_image_classifier_model.keras' # Path to save the best model
+CLASS_NAMES_PATH = 'class_names.json' # Class names in model output order, used for inference
+EXPORT_TFLITE = False # Export float32/dynamic-range/int8 TFLite models and benchmark them after training
+METRICS_LOG_PATH = 'training_metrics.jsonl' # One JSON line per run: stage timings, skip counts, epoch throughput
+METRICS_PROMETHEUS_PATH = None # Set to e.g. 'training_metrics.prom' for the node_exporter textfile collector
 
-def load_and_preprocess_data(base_dir):
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif') # Image file types picked up from the class folders
+
+# How training data is fed to the model:
+#   'in_memory' - load every crop into one NumPy array up front (fast for small datasets)
+#   'streaming' - tf.data pipeline that decodes/crops/resizes per batch, so memory is bounded by BATCH_SIZE
+#   'feature_cache' - run the frozen backbone once per image, cache the embeddings on disk and train only the head
+#   'memmap' - write the uint8 crops once to a memory-mapped store and normalize per batch at training time
+DATA_PIPELINE = 'in_memory'
+FEATURE_CACHE_PATH = 'feature_cache.npz' # Embeddings cache used by the 'feature_cache' pipeline
+FEATURE_BACKBONE = 'mobilenet_v2_imagenet' # Part of the cache key; change it if the backbone changes
+FEATURE_DIM = 1280 # Size of the pooled MobileNetV2 embedding
+CROP_CACHE_DIR = None # Set to a directory (e.g. 'crop_cache') to keep cropped images between 'in_memory'/'memmap' runs
+NUM_LOAD_WORKERS = 1 # Worker processes for decoding/cropping in the 'in_memory'/'memmap' pipelines (e.g. os.cpu_count())
+MANIFEST_PATH = None # Set to a file (e.g. 'manifest.npz') to index IMAGE_DIR once instead of re-scanning it every run
+MEMMAP_STORE_DIR = 'dataset_store' # Memory-mapped uint8 crops used by the 'memmap' pipeline, reused across runs
+MEMMAP_IMAGES_FILENAME = 'images.u8'
+FAST_DECODE = False # Decode large JPEGs at reduced DCT scale and reduce before LANCZOS (see check_fast_decode_quality)
+FAST_DECODE_OVERSAMPLE = 2.0 # Draft-mode decoding keeps the crop at least this many times the input size, so LANCZOS still sees detail
+FAST_DECODE_REDUCING_GAP = 3.0 # Pillow reducing_gap for the fast path; larger values stay closer to a plain LANCZOS resize
+FAST_DECODE_TOLERANCE = 2.0 # Max per-image mean absolute pixel difference (0-255) accepted by check_fast_decode_quality
+DEDUP_MODE = None # 'flag' reports near-duplicate images while loading ('in_memory'/'memmap'); 'drop' also leaves out copies within the same class
+DEDUP_MAX_DISTANCE = 4 # Perceptual hashes (64-bit dHash of the crop) at most this many bits apart are near-duplicates
+
+# Incremental training: fine-tune the last checkpoint on new or changed images plus a replay sample of old ones
+INCREMENTAL_TRAINING = False # Falls back to full training when there is no checkpoint or training state yet
+TRAINING_STATE_PATH = 'training_state.json' # Classes and images (by path and mtimes) the saved model was trained on; written only with INCREMENTAL_TRAINING
+INCREMENTAL_EPOCHS = 20
+INCREMENTAL_LEARNING_RATE = 0.0001 # Lower than the initial rate so fine-tuning does not wash out earlier training
+REPLAY_RATIO = 1.0 # Old images replayed per new image, spread evenly over the already-trained classes
+REPLAY_MIN_PER_CLASS = 10 # Replay at least this many images of every old class, so small classes are not forgotten
+INCREMENTAL_BACKUP_DIR = 'incremental_backup' # Weights, optimizer state and epoch counter for resuming an interrupted run
+
+def list_class_names(base_dir):
+    """Returns the sorted class folder names found directly under base_dir."""
+    return sorted([d for d in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, d))])
+
+def list_annotated_images(class_path):
+    """
+    Yields (img_path, xml_path) for every image in class_path that has a sibling VOC XML file.
+    Images without an XML file are reported and skipped.
+    """
+    start = time.perf_counter()
+    item_names = os.listdir(class_path)
+    metrics.observe('directory_scan', time.perf_counter() - start, items=len(item_names))
+    for item_name in item_names:
+        # Process only common image file types
+        if item_name.lower().endswith(IMAGE_EXTENSIONS):
+            img_path = os.path.join(class_path, item_name)
+            # Construct corresponding XML file path
+            xml_filename = os.path.splitext(item_name)[0] + '.xml'
+            xml_path = os.path.join(class_path, xml_filename)
+
+            start = time.perf_counter()
+            xml_exists = os.path.exists(xml_path)
+            metrics.observe('directory_scan', time.perf_counter() - start, items=0)
+            if not xml_exists:
+                print(f"Warning: XML file '{xml_path}' not found for image '{img_path}'. Skipping this image.")
+                metrics.count_skip('missing_xml')
+                continue
+            yield img_path, xml_path
+
+def parse_bounding_box(xml_path):
+    """
+    Returns the (xmin, ymin, xmax, ymax) box of the first <object> in a VOC XML file,
+    or None (after printing a warning) if the file has no <object>/<bndbox>.
+    Raises ET.ParseError / ValueError for malformed files.
+    """
+    start = time.perf_counter()
+    tree = ET.parse(xml_path)
+    root = tree.getroot()
+    metrics.observe('xml_parse', time.perf_counter() - start, nbytes=os.path.getsize(xml_path))
+
+    obj_element = root.find('object')
+    if obj_element is None:
+        print(f"Warning: No <object> tag found in '{xml_path}'. Skipping this image.")
+        metrics.count_skip('no_object')
+        return None
+
+    bndbox = obj_element.find('bndbox')
+    if bndbox is None:
+        print(f"Warning: No <bndbox> tag found in <object> in '{xml_path}'. Skipping this image.")
+        metrics.count_skip('no_bndbox')
+        return None
+
+    xmin = int(bndbox.find('xmin').text)
+    ymin = int(bndbox.find('ymin').text)
+    xmax = int(bndbox.find('xmax').text)
+    ymax = int(bndbox.find('ymax').text)
+    return xmin, ymin, xmax, ymax
+
+def _draft_for_crop(img, bbox):
+    """
+    Asks the JPEG decoder to decode at a reduced DCT scale (1/2, 1/4 or 1/8) when that still leaves the
+    crop at least FAST_DECODE_OVERSAMPLE times the model input size on each side.
+    Returns bbox mapped into the coordinates of the reduced image.
+    """
+    if img.format != 'JPEG':
+        return bbox
+    full_width, full_height = img.size
+    box_width, box_height = (bbox[2] - bbox[0], bbox[3] - bbox[1]) if bbox is not None else img.size
+    scale = min(box_width / IMG_WIDTH, box_height / IMG_HEIGHT) / FAST_DECODE_OVERSAMPLE
+    if scale < 2:
+        return bbox
+    # draft() picks the strongest reduction whose result is still at least the requested size
+    img.draft('RGB', (int(np.ceil(full_width / scale)), int(np.ceil(full_height / scale))))
+    if img.size == (full_width, full_height) or bbox is None:
+        return bbox
+    scale_x = img.size[0] / full_width
+    scale_y = img.size[1] / full_height
+    return (int(round(bbox[0] * scale_x)), int(round(bbox[1] * scale_y)),
+            int(round(bbox[2] * scale_x)), int(round(bbox[3] * scale_y)))
+
+def crop_and_resize(img_path, bbox, fast_decode=None):
+    """
+    Loads an image (a path or a file object), crops it to bbox and resizes it to the model input size.
+    A bbox of None keeps the whole image. Returns a uint8 array.
+    With fast_decode (default: FAST_DECODE), large JPEGs are decoded at a reduced DCT scale, only the
+    cropped region is converted to RGB, and the resize reduces by whole factors before LANCZOS.
+    """
+    if fast_decode is None:
+        fast_decode = FAST_DECODE
+    if fast_decode:
+        start = time.perf_counter()
+        img = Image.open(img_path)
+        bbox = _draft_for_crop(img, bbox)
+        img.load()
+        metrics.observe('decode', time.perf_counter() - start, nbytes=img.width * img.height * len(img.getbands()))
+
+        start = time.perf_counter()
+        img_cropped = (img.crop(bbox) if bbox is not None else img).convert('RGB')
+        metrics.observe('crop', time.perf_counter() - start, nbytes=img_cropped.width * img_cropped.height * 3)
+
+        start = time.perf_counter()
+        img_resized = img_cropped.resize((IMG_WIDTH, IMG_HEIGHT), Image.LANCZOS, reducing_gap=FAST_DECODE_REDUCING_GAP)
+        img_array = np.array(img_resized)
+        metrics.observe('resize', time.perf_counter() - start, nbytes=img_array.nbytes)
+        return img_array
+
+    # Load image
+    start = time.perf_counter()
+    img = Image.open(img_path).convert('RGB') # Ensure image is in RGB
+    metrics.observe('decode', time.perf_counter() - start, nbytes=img.width * img.height * 3)
+
+    # Crop image using bounding box
+    start = time.perf_counter()
+    img_cropped = img.crop(bbox) if bbox is not None else img
+    metrics.observe('crop', time.perf_counter() - start, nbytes=img_cropped.width * img_cropped.height * 3)
+
+    # Resize cropped image
+    start = time.perf_counter()
+    img_resized = img_cropped.resize((IMG_WIDTH, IMG_HEIGHT), Image.LANCZOS) # Use LANCZOS for quality
+    img_array = np.array(img_resized)
+    metrics.observe('resize', time.perf_counter() - start, nbytes=img_array.nbytes)
+
+    return img_array
+
+def check_fast_decode_quality(items, tolerance=None):
+    """
+    Decodes (img_path, bbox) items with both the standard and the fast path and compares the pixels.
+    Returns a dict with the mean and max absolute difference (0-255 scale), the worst per-image mean,
+    both paths' total times and whether the worst per-image mean difference is within tolerance.
+    """
+    if tolerance is None:
+        tolerance = FAST_DECODE_TOLERANCE
+    per_image_mean, max_diff = [], 0
+    standard_seconds = fast_seconds = 0.0
+    for img_path, bbox in items:
+        start = time.perf_counter()
+        standard = crop_and_resize(img_path, bbox, fast_decode=False).astype(np.int16)
+        standard_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        fast = crop_and_resize(img_path, bbox, fast_decode=True).astype(np.int16)
+        fast_seconds += time.perf_counter() - start
+        diff = np.abs(standard - fast)
+        per_image_mean.append(float(diff.mean()))
+        max_diff = max(max_diff, int(diff.max()))
+    worst = max(per_image_mean) if per_image_mean else 0.0
+    return {
+        'images': len(per_image_mean),
+        'mean_abs_diff': float(np.mean(per_image_mean)) if per_image_mean else 0.0,
+        'worst_image_mean_abs_diff': worst,
+        'max_abs_diff': max_diff,
+        'standard_seconds': standard_seconds,
+        'fast_seconds': fast_seconds,
+        'tolerance': tolerance,
+        'within_tolerance': worst <= tolerance,
+    }
+
+def load_annotated_crop(img_path, xml_path, bbox=None):
+    """
+    Parses the bounding box for one image and returns (bbox, img_array) with the cropped and resized uint8 array.
+    If bbox is already known (e.g. from the manifest) the XML is not read.
+    Returns None (after printing a warning) if the XML or image cannot be used.
+    """
+    try:
+        # Parse XML for bounding box
+        if bbox is None:
+            bbox = parse_bounding_box(xml_path)
+        if bbox is None:
+            return None
+        return bbox, crop_and_resize(img_path, bbox)
+    except Exception as e:
+        report_load_error(e, img_path, xml_path)
+        return None
+
+def load_annotated_image(img_path, xml_path):
+    """Returns the cropped and resized uint8 array for one annotated image, or None if it was skipped."""
+    result = load_annotated_crop(img_path, xml_path)
+    return None if result is None else result[1]
+
+def report_load_error(error, img_path, xml_path):
+    """Prints the skip warning for an exception raised while loading an annotated image."""
+    if isinstance(error, ET.ParseError):
+        print(f"Warning: Could not parse XML file '{xml_path}'. Skipping related image.")
+        metrics.count_skip('xml_parse_error')
+    elif isinstance(error, FileNotFoundError):
+        print(f"Warning: Image file '{img_path}' (referenced in XML or listing) not found. Skipping.")
+        metrics.count_skip('missing_image')
+    elif isinstance(error, ValueError): # Catch issues like invalid text in xmin etc.
+        print(f"Warning: Invalid data in XML '{xml_path}' (e.g., non-integer for bbox): {error}. Skipping.")
+        metrics.count_skip('bad_bbox')
+    else:
+        print(f"Error processing image '{img_path}' or XML '{xml_path}': {error}. Skipping.")
+        metrics.count_skip('decode_error')
+
+class CropCache:
+    """
+    On-disk cache of cropped and resized uint8 images, one .npy file per source image.
+    An entry is reused only while the image and XML files keep the same mtime and size, the target size
+    is unchanged and (when the caller knows it) the bounding box matches, so edited images or annotations
+    are processed again automatically.
+    """
+
+    INDEX_FILENAME = 'index.json'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, self.INDEX_FILENAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Warning: Could not read crop cache index '{self.index_path}': {e}. Rebuilding it.")
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _file_signature(path):
+        stat = os.stat(path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def _signature(self, img_path, xml_path):
+        return {
+            'image': self._file_signature(img_path),
+            'xml': self._file_signature(xml_path),
+            'size': [IMG_WIDTH, IMG_HEIGHT],
+            'fast_decode': FAST_DECODE,
+        }
+
+    def lookup(self, img_path, xml_path, bbox=None):
+        """Returns the cached uint8 array if the entry is still valid (and was cropped with bbox, if given), otherwise None."""
+        key = os.path.abspath(img_path)
+        self.seen.add(key)
+        entry = self.index.get(key)
+        if entry is not None:
+            try:
+                signature = self._signature(img_path, xml_path)
+                if bbox is not None:
+                    signature['bbox'] = [int(v) for v in bbox]
+                if all(entry.get(name) == value for name, value in signature.items()):
+                    img_array = np.load(os.path.join(self.cache_dir, entry['file']))
+                    self.hits += 1
+                    return img_array
+            except (OSError, ValueError):
+                pass # Source or cached file missing or corrupt, process the image again
+        self.misses += 1
+        return None
+
+    def store(self, img_path, xml_path, bbox, img_array):
+        """Saves a freshly processed crop."""
+        key = os.path.abspath(img_path)
+        try:
+            signature = self._signature(img_path, xml_path)
+        except OSError:
+            return # Source files vanished while processing; nothing worth caching
+        filename = hashlib.sha1(key.encode()).hexdigest() + '.npy'
+        np.save(os.path.join(self.cache_dir, filename), img_array)
+        self.index[key] = dict(signature, bbox=[int(v) for v in bbox], file=filename)
+
+    def load(self, img_path, xml_path, bbox=None):
+        """
+        Returns the cropped uint8 array for an annotated image, from the cache if it is still valid,
+        otherwise by processing it with the same checks and warnings as load_annotated_image.
+        """
+        img_array = self.lookup(img_path, xml_path, bbox)
+        if img_array is not None:
+            return img_array
+        result = load_annotated_crop(img_path, xml_path, bbox)
+        if result is None:
+            return None
+        bbox, img_array = result
+        self.store(img_path, xml_path, bbox, img_array)
+        return img_array
+
+    def save(self):
+        """Evicts entries for images not seen since the cache was opened and writes the index."""
+        for key in [k for k in self.index if k not in self.seen]:
+            try:
+                os.remove(os.path.join(self.cache_dir, self.index[key]['file']))
+            except OSError:
+                pass
+            del self.index[key]
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+        print(f"Crop cache: {self.hits} reused, {self.misses} processed, {len(self.index)} entries in '{self.cache_dir}'.")
+
+def list_dataset_samples(base_dir):
+    """
+    Lists every annotated image under base_dir without decoding anything.
+    Returns (class_names, samples) where samples is a list of (img_path, xml_path, class_index),
+    or ([], []) after printing an error if no class folders or annotated images were found.
+    """
+    class_names = list_class_names(base_dir)
+    if not class_names:
+        print(f"Error: No subdirectories (class folders) found in '{base_dir}'.")
+        print("Please ensure your data is structured as 'dir/class1_folder', 'dir/class2_folder', etc.")
+        return [], []
+
+    print(f"Found class folders: {class_names}")
+
+    samples = []
+    for class_index, class_name in enumerate(class_names):
+        class_path = os.path.join(base_dir, class_name)
+        file_count = 0
+        for img_path, xml_path in list_annotated_images(class_path):
+            samples.append((img_path, xml_path, class_index))
+            file_count += 1
+        print(f"Found {file_count} annotated images for class '{class_name}'.")
+
+    if not samples:
+        print("Error: No annotated images were found. Please check paths, file formats, and XML content.")
+        return [], []
+    return class_names, samples
+
+MANIFEST_COLUMNS = ('img_paths', 'xml_paths', 'labels', 'bboxes', 'image_sizes', 'img_mtimes', 'xml_mtimes', 'skipped')
+
+def load_manifest(manifest_path, base_dir):
+    """Loads a manifest written by update_manifest as a dict of arrays, or None if it is missing, unreadable or for another base_dir."""
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with np.load(manifest_path, allow_pickle=False) as data:
+            manifest = {name: data[name] for name in data.files}
+    except Exception as e:
+        print(f"Warning: Could not read manifest '{manifest_path}': {e}. Rebuilding it.")
+        return None
+    if str(manifest.get('base_dir')) != os.path.abspath(base_dir):
+        return None
+    return manifest
+
+def _manifest_row(img_path, xml_path, class_index, previous_row=None):
+    """
+    Returns the manifest row for one image/XML pair, or None if either file has disappeared.
+    previous_row is reused while the image and XML mtimes still match; otherwise the XML is parsed and the
+    image header read again. Pairs that cannot be used get a row with skipped=True, so they are checked
+    again (instead of being forgotten) once either file changes.
+    """
+    try:
+        img_mtime = os.stat(img_path).st_mtime_ns
+        xml_mtime = os.stat(xml_path).st_mtime_ns
+    except OSError as e:
+        report_load_error(e, img_path, xml_path)
+        return None
+    if previous_row is not None and previous_row[5] == img_mtime and previous_row[6] == xml_mtime:
+        return (img_path, xml_path, class_index) + previous_row[3:]
+    skipped_row = (img_path, xml_path, class_index, (0, 0, 0, 0), (0, 0), img_mtime, xml_mtime, True)
+    try:
+        bbox = parse_bounding_box(xml_path)
+        if bbox is None:
+            return skipped_row
+        with Image.open(img_path) as img: # Reads the header only, pixels are not decoded
+            image_size = img.size
+    except Exception as e:
+        report_load_error(e, img_path, xml_path)
+        return skipped_row
+    return (img_path, xml_path, class_index, bbox, image_size, img_mtime, xml_mtime, False)
+
+def update_manifest(base_dir, manifest_path):
+    """
+    Builds or incrementally updates a compact columnar index of the dataset and saves it as an .npz file.
+    There is one row per annotated image: paths, class index, bbox, image size, file mtimes and a skipped flag.
+    Class folders whose directory mtime is unchanged are not listed again, so a rerun on an unchanged tree
+    only stats the folders and the files in them; images and annotations edited in place (which does not
+    change the folder mtime) are read again. Rows of images that could not be used are kept with skipped=True,
+    so fixing one in place brings it back.
+    Returns the usable rows as a dict of arrays (see MANIFEST_COLUMNS) plus 'classes'.
+    """
+    previous = load_manifest(manifest_path, base_dir)
+    previous_classes = {}
+    if previous is not None:
+        previous_skipped = previous.get('skipped', np.zeros(len(previous['img_paths']), dtype=bool))
+        for class_index, (class_name, dir_mtime) in enumerate(zip(previous['classes'].tolist(), previous['dir_mtimes'].tolist())):
+            row_indices = np.flatnonzero(previous['labels'] == class_index)
+            rows = {}
+            for i in row_indices:
+                img_path = str(previous['img_paths'][i])
+                rows[img_path] = (img_path, str(previous['xml_paths'][i]), class_index,
+                                  tuple(previous['bboxes'][i].tolist()), tuple(previous['image_sizes'][i].tolist()),
+                                  int(previous['img_mtimes'][i]), int(previous['xml_mtimes'][i]), bool(previous_skipped[i]))
+            previous_classes[class_name] = (dir_mtime, rows)
+
+    class_names = list_class_names(base_dir)
+    rows = []
+    rescanned = 0
+    for class_index, class_name in enumerate(class_names):
+        class_path = os.path.join(base_dir, class_name)
+        dir_mtime = os.stat(class_path).st_mtime_ns
+        previous_dir_mtime, previous_rows = previous_classes.get(class_name, (None, {}))
+        if previous_dir_mtime == dir_mtime:
+            pairs = [(row[0], row[1]) for row in previous_rows.values()]
+        else:
+            pairs = list_annotated_images(class_path)
+            rescanned += 1
+        for img_path, xml_path in pairs:
+            row = _manifest_row(img_path, xml_path, class_index, previous_rows.get(img_path))
+            if row is not None:
+                rows.append(row)
+    skipped = sum(1 for row in rows if row[7])
+    print(f"Manifest: {len(rows) - skipped} images in {len(class_names)} classes ({rescanned} folders rescanned"
+          f"{f', {skipped} unusable images skipped' if skipped else ''}).")
+
+    manifest = {
+        'base_dir': np.array(os.path.abspath(base_dir)),
+        'classes': np.array(class_names, dtype=str),
+        'dir_mtimes': np.array([os.stat(os.path.join(base_dir, c)).st_mtime_ns for c in class_names], dtype=np.int64),
+        'img_paths': np.array([row[0] for row in rows], dtype=str),
+        'xml_paths': np.array([row[1] for row in rows], dtype=str),
+        'labels': np.array([row[2] for row in rows], dtype=np.int32),
+        'bboxes': np.array([row[3] for row in rows], dtype=np.int32).reshape(-1, 4),
+        'image_sizes': np.array([row[4] for row in rows], dtype=np.int32).reshape(-1, 2),
+        'img_mtimes': np.array([row[5] for row in rows], dtype=np.int64),
+        'xml_mtimes': np.array([row[6] for row in rows], dtype=np.int64),
+        'skipped': np.array([row[7] for row in rows], dtype=bool),
+    }
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **manifest)
+    os.replace(tmp_path, manifest_path)
+    usable = ~manifest['skipped']
+    return {name: values[usable] if name in MANIFEST_COLUMNS else values for name, values in manifest.items()}
+
+def _load_annotated_crop_captured(img_path, xml_path, bbox):
+    """
+    Worker-process wrapper for load_annotated_crop that returns its warnings and metrics,
+    so the parent prints them in order and merges the measurements.
+    """
+    metrics.reset() # Only this call's measurements go back to the parent
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = load_annotated_crop(img_path, xml_path, bbox)
+    return result, output.getvalue(), metrics.snapshot()
+
+def load_crops(items, crop_cache=None, executor=None, num_workers=1):
+    """
+    Yields the cropped uint8 array (or None if the image was skipped) for each (img_path, xml_path, bbox), in input order.
+    bbox may be None, in which case it is parsed from the XML.
+    With a process pool executor, cache misses are parsed, decoded, cropped and resized in the worker processes.
+    """
+    if executor is None:
+        for img_path, xml_path, bbox in items:
+            if crop_cache is not None:
+                yield crop_cache.load(img_path, xml_path, bbox)
+            else:
+                result = load_annotated_crop(img_path, xml_path, bbox)
+                yield None if result is None else result[1]
+        return
+
+    items = list(items)
+    results = [None] * len(items)
+    misses = []
+    for i, (img_path, xml_path, bbox) in enumerate(items):
+        cached = crop_cache.lookup(img_path, xml_path, bbox) if crop_cache is not None else None
+        if cached is None:
+            misses.append(i)
+        else:
+            results[i] = cached
+
+    # A few chunks per worker keeps IPC overhead low while still balancing uneven image sizes
+    chunksize = max(1, len(misses) // (num_workers * 4))
+    loaded = executor.map(_load_annotated_crop_captured,
+                          *zip(*[items[i] for i in misses]),
+                          chunksize=chunksize)
+    for i, (result, warnings, worker_metrics) in zip(misses, loaded):
+        print(warnings, end='')
+        metrics.merge(worker_metrics)
+        if result is None:
+            continue
+        bbox, img_array = result
+        if crop_cache is not None:
+            crop_cache.store(items[i][0], items[i][1], bbox, img_array)
+        results[i] = img_array
+    yield from results
+
+def check_duplicate(hash_index, img_array, img_path, class_name, dedup_mode):
+    """
+    Looks the crop up in hash_index and reports a near-duplicate of an earlier image.
+    Returns True if the image should be dropped; otherwise the crop is added to the index.
+    Duplicates labelled with a different class are only flagged, since there is no telling which label is right.
+    """
+    with metrics.timed('dedup_hash', nbytes=img_array.nbytes):
+        image_hash = perceptual_hash(img_array)
+        match = hash_index.find(image_hash)
+    if match is None:
+        hash_index.add(image_hash, (img_path, class_name))
+        return False
+    (first_path, first_class), distance = match
+    conflict = f" (labelled '{first_class}' there)" if first_class != class_name else ''
+    drop = dedup_mode == 'drop' and not conflict
+    action = "Skipping this image." if drop else "Keeping it; please check the labels." if conflict else "Keeping it."
+    print(f"Warning: Image '{img_path}' is a near-duplicate of '{first_path}'{conflict}, "
+          f"{distance} bits apart. {action}")
+    metrics.count_skip('duplicate_conflicting_class' if conflict else 'duplicate')
+    if drop:
+        return True
+    hash_index.add(image_hash, (img_path, class_name))
+    return False
+
+def iter_dataset_crops(base_dir, class_names, manifest=None, crop_cache_dir=None, num_workers=1):
+    """
+    Yields (class_name, img_array) for every usable image, class by class, printing per-class progress.
+    With DEDUP_MODE set, near-duplicates of earlier images (in any class) are reported, and dropped in 'drop' mode.
+    See load_and_preprocess_data for the meaning of the other options.
+    """
+    crop_cache = CropCache(crop_cache_dir) if crop_cache_dir else None
+    hash_index = HashIndex(DEDUP_MAX_DISTANCE) if DEDUP_MODE else None
+    executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+    try:
+        for class_index, class_name in enumerate(class_names):
+            class_path = os.path.join(base_dir, class_name)
+            print(f"Processing class: {class_name}")
+            file_count = 0
+            if manifest is not None:
+                rows = np.flatnonzero(manifest['labels'] == class_index)
+                items = [(str(manifest['img_paths'][i]), str(manifest['xml_paths'][i]), tuple(manifest['bboxes'][i].tolist()))
+                         for i in rows]
+            else:
+                items = [(img_path, xml_path, None) for img_path, xml_path in list_annotated_images(class_path)]
+            crops = load_crops(items, crop_cache=crop_cache, executor=executor, num_workers=num_workers)
+            for (img_path, _, _), img_array in zip(items, crops):
+                if img_array is None:
+                    continue
+                if hash_index is not None and check_duplicate(hash_index, img_array, img_path, class_name, DEDUP_MODE):
+                    continue
+
+                yield class_name, img_array # Folder name is the class label
+                file_count += 1
+            print(f"Loaded {file_count} images for class '{class_name}'.")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if crop_cache is not None:
+        crop_cache.save()
+
+def load_and_preprocess_data(base_dir, crop_cache_dir=None, num_workers=1, manifest_path=None):
     """
     Loads images, parses XMLs for bounding boxes, crops, resizes, and preprocesses images.
     The class label is derived from the subfolder name.
+    If crop_cache_dir is set, crops are reused from (and saved to) a CropCache there, so only
+    new or changed images are decoded.
+    With num_workers > 1, images are processed in a pool of worker processes; results keep the serial order.
+    If manifest_path is set, files and bounding boxes come from the (incrementally updated) manifest
+    instead of walking the class folders and parsing every XML.
     """
     images = []
     labels = []
     
     # Get class names from the subdirectories in base_dir
-    class_names = sorted([d for d in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, d))])
+    manifest = update_manifest(base_dir, manifest_path) if manifest_path else None
+    class_names = manifest['classes'].tolist() if manifest is not None else list_class_names(base_dir)
     
     if not class_names:
         print(f"Error: No subdirectories (class folders) found in '{base_dir}'.")
@@ -39,120 +630,374 @@ def load_and_preprocess_data(base_dir):
 
     print(f"Found class folders: {class_names}")
 
-    for class_name in class_names:
-        class_path = os.path.join(base_dir, class_name)
-        print(f"Processing class: {class_name}")
-        file_count = 0
-        for item_name in os.listdir(class_path):
-            # Process only common image file types
-            if item_name.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-                img_path = os.path.join(class_path, item_name)
-                # Construct corresponding XML file path
-                xml_filename = os.path.splitext(item_name)[0] + '.xml'
-                xml_path = os.path.join(class_path, xml_filename)
-
-                if not os.path.exists(xml_path):
-                    print(f"Warning: XML file '{xml_path}' not found for image '{img_path}'. Skipping this image.")
-                    continue
-
-                try:
-                    # Parse XML for bounding box
-                    tree = ET.parse(xml_path)
-                    root = tree.getroot()
-                    
-                    obj_element = root.find('object')
-                    if obj_element is None:
-                        print(f"Warning: No <object> tag found in '{xml_path}'. Skipping this image.")
-                        continue
-                    
-                    bndbox = obj_element.find('bndbox')
-                    if bndbox is None:
-                        print(f"Warning: No <bndbox> tag found in <object> in '{xml_path}'. Skipping this image.")
-                        continue
-
-                    xmin = int(bndbox.find('xmin').text)
-                    ymin = int(bndbox.find('ymin').text)
-                    xmax = int(bndbox.find('xmax').text)
-                    ymax = int(bndbox.find('ymax').text)
-
-                    # Load image
-                    img = Image.open(img_path).convert('RGB') # Ensure image is in RGB
-                    
-                    # Crop image using bounding box
-                    img_cropped = img.crop((xmin, ymin, xmax, ymax))
-                    
-                    # Resize cropped image
-                    img_resized = img_cropped.resize((IMG_WIDTH, IMG_HEIGHT), Image.LANCZOS) # Use LANCZOS for quality
-                    
-                    img_array = np.array(img_resized)
-                    
-                    images.append(img_array)
-                    labels.append(class_name) # Folder name is the class label
-                    file_count += 1
-
-                except ET.ParseError:
-                    print(f"Warning: Could not parse XML file '{xml_path}'. Skipping related image.")
-                except FileNotFoundError:
-                    print(f"Warning: Image file '{img_path}' (referenced in XML or listing) not found. Skipping.")
-                except ValueError as ve: # Catch issues like invalid text in xmin etc.
-                     print(f"Warning: Invalid data in XML '{xml_path}' (e.g., non-integer for bbox): {ve}. Skipping.")
-                except Exception as e:
-                    print(f"Error processing image '{img_path}' or XML '{xml_path}': {e}. Skipping.")
-        print(f"Loaded {file_count} images for class '{class_name}'.")
+    for class_name, img_array in iter_dataset_crops(base_dir, class_names, manifest=manifest,
+                                                    crop_cache_dir=crop_cache_dir, num_workers=num_workers):
+        images.append(img_array)
+        labels.append(class_name)
     
     if not images:
         print("Error: No images were successfully loaded. Please check paths, file formats, and XML content.")
         return np.array([]), np.array([]), []
 
     # Convert images list to numpy array and preprocess for MobileNetV2
-    images_np = np.array(images, dtype=np.float32)
-    images_preprocessed = tf.keras.applications.mobilenet_v2.preprocess_input(images_np) 
+    with metrics.timed('preprocess_input', items=len(images), nbytes=len(images) * images[0].nbytes * 4):
+        images_np = np.array(images, dtype=np.float32)
+        images_preprocessed = tf.keras.applications.mobilenet_v2.preprocess_input(images_np) 
 
     # Encode string labels to numerical format (integers)
-    label_encoder = LabelEncoder()
-    labels_encoded = label_encoder.fit_transform(labels)
-    # Convert numerical labels to one-hot encoded vectors
-    labels_categorical = tf.keras.utils.to_categorical(labels_encoded, num_classes=len(class_names))
+    with metrics.timed('label_encoding', items=len(labels)):
+        label_encoder = LabelEncoder()
+        labels_encoded = label_encoder.fit_transform(labels)
+        # Convert numerical labels to one-hot encoded vectors
+        labels_categorical = tf.keras.utils.to_categorical(labels_encoded, num_classes=len(class_names))
     
     return images_preprocessed, labels_categorical, label_encoder.classes_
 
-def build_model(num_classes, input_shape):
-    """Builds a classification model using MobileNetV2 as a base."""
+def _load_annotated_image_tf(img_path, xml_path, label):
+    """tf.data map stage: runs load_annotated_image in a worker thread. `ok` is False for skipped samples."""
+    def _load(img_path, xml_path):
+        img_array = load_annotated_image(img_path.decode(), xml_path.decode())
+        if img_array is None:
+            return np.zeros((IMG_HEIGHT, IMG_WIDTH, 3), dtype=np.uint8), False
+        return img_array, True
+
+    image, ok = tf.numpy_function(_load, [img_path, xml_path], [tf.uint8, tf.bool])
+    image.set_shape((IMG_HEIGHT, IMG_WIDTH, 3))
+    ok.set_shape(())
+    return image, label, ok
+
+def make_streaming_dataset(img_paths, xml_paths, label_indices, num_classes, batch_size=BATCH_SIZE, shuffle=False):
+    """
+    Builds a tf.data pipeline over (image, XML, label) file lists.
+    Parsing, cropping, resizing and preprocess_input run in parallel map stages and batches are
+    prefetched, so only a few batches are ever held in memory.
+    """
+    ds = tf.data.Dataset.from_tensor_slices((list(img_paths), list(xml_paths), np.asarray(label_indices, dtype=np.int32)))
+    if shuffle:
+        # Shuffling file names (not pixels) is cheap, so the whole list fits in the buffer
+        ds = ds.shuffle(len(img_paths), seed=42, reshuffle_each_iteration=True)
+    ds = ds.map(_load_annotated_image_tf, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    ds = ds.filter(lambda image, label, ok: ok) # Drop images that were skipped with a warning
+    ds = ds.map(
+        lambda image, label, ok: (
+            tf.keras.applications.mobilenet_v2.preprocess_input(tf.cast(image, tf.float32)),
+            tf.one_hot(label, num_classes),
+        ),
+        num_parallel_calls=tf.data.AUTOTUNE,
+    )
+    return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+def build_streaming_datasets(base_dir, batch_size=BATCH_SIZE):
+    """
+    Lists (image, XML, label) triples, splits them on indices and wraps each split in a streaming tf.data pipeline.
+    Returns (train_ds, val_ds, class_names, num_train, num_val); val_ds is None when there is no validation data.
+    Sample counts are taken before decoding, so images skipped later with a warning are still included in them.
+    """
+    class_names, samples = list_dataset_samples(base_dir)
+    if not samples:
+        return None, None, [], 0, 0
+
+    img_paths, xml_paths, label_indices = (np.array(column) for column in zip(*samples))
+    num_classes = len(class_names)
+
+    # Split indices, not pixels, so no image data is copied
+    train_idx, val_idx = train_test_split(
+        np.arange(len(img_paths)),
+        test_size=VALIDATION_SPLIT,
+        random_state=42,
+        stratify=label_indices if num_classes > 1 else None
+    )
+
+    train_ds = make_streaming_dataset(img_paths[train_idx], xml_paths[train_idx], label_indices[train_idx],
+                                      num_classes, batch_size=batch_size, shuffle=True)
+    val_ds = None
+    if len(val_idx) > 0:
+        val_ds = make_streaming_dataset(img_paths[val_idx], xml_paths[val_idx], label_indices[val_idx],
+                                        num_classes, batch_size=batch_size)
+    return train_ds, val_ds, np.array(class_names), len(train_idx), len(val_idx)
+
+def dataset_fingerprint(base_dir, manifest=None):
+    """Returns a hash of the dataset's file names, mtimes and sizes (or of the manifest) plus the target image size, decode and dedup modes."""
+    digest = hashlib.sha1(f"{IMG_WIDTH}x{IMG_HEIGHT}|fast={FAST_DECODE}|dedup={DEDUP_MODE}:{DEDUP_MAX_DISTANCE}".encode())
+    if manifest is not None:
+        for name in MANIFEST_COLUMNS:
+            digest.update(np.ascontiguousarray(manifest[name]).tobytes())
+        return digest.hexdigest()
+    for class_name in list_class_names(base_dir):
+        for entry in sorted(os.scandir(os.path.join(base_dir, class_name)), key=lambda e: e.name):
+            stat = entry.stat()
+            digest.update(f"{class_name}/{entry.name}|{stat.st_mtime_ns}|{stat.st_size}\n".encode())
+    return digest.hexdigest()
+
+def build_memmap_store(base_dir, store_dir, crop_cache_dir=None, num_workers=1, manifest_path=None):
+    """
+    Writes every crop as raw uint8 into store_dir/images.u8 (one HxWx3 record per image), with the class
+    indices in labels.npy and the class names, count and dataset fingerprint in meta.json.
+    Crops are streamed to disk as they are loaded, so the full dataset is never held in RAM.
+    Returns True if at least one image was written.
+    """
+    manifest = update_manifest(base_dir, manifest_path) if manifest_path else None
+    class_names = manifest['classes'].tolist() if manifest is not None else list_class_names(base_dir)
+    if not class_names:
+        print(f"Error: No subdirectories (class folders) found in '{base_dir}'.")
+        print("Please ensure your data is structured as 'dir/class1_folder', 'dir/class2_folder', etc.")
+        return False
+
+    print(f"Found class folders: {class_names}")
+    os.makedirs(store_dir, exist_ok=True)
+    class_indices = {name: i for i, name in enumerate(class_names)}
+    labels = []
+    images_tmp_path = os.path.join(store_dir, MEMMAP_IMAGES_FILENAME + '.tmp')
+    with open(images_tmp_path, 'wb') as f:
+        for class_name, img_array in iter_dataset_crops(base_dir, class_names, manifest=manifest,
+                                                        crop_cache_dir=crop_cache_dir, num_workers=num_workers):
+            f.write(np.ascontiguousarray(img_array, dtype=np.uint8).tobytes())
+            labels.append(class_indices[class_name])
+
+    if not labels:
+        os.remove(images_tmp_path)
+        print("Error: No images were successfully loaded. Please check paths, file formats, and XML content.")
+        return False
+
+    os.replace(images_tmp_path, os.path.join(store_dir, MEMMAP_IMAGES_FILENAME))
+    np.save(os.path.join(store_dir, 'labels.npy'), np.array(labels, dtype=np.int32))
+    meta = {
+        'count': len(labels),
+        'shape': [IMG_HEIGHT, IMG_WIDTH, 3],
+        'classes': class_names,
+        'fingerprint': dataset_fingerprint(base_dir, manifest),
+    }
+    # meta.json is written last, so an interrupted build is never mistaken for a complete store
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    print(f"Wrote {len(labels)} images to the memory-mapped store in '{store_dir}'.")
+    return True
+
+def open_memmap_store(store_dir):
+    """
+    Opens a store written by build_memmap_store read-only.
+    Returns (images, labels, class_names, meta); images is an np.memmap, so pages are shared between processes.
+    """
+    with open(os.path.join(store_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    images = np.memmap(os.path.join(store_dir, MEMMAP_IMAGES_FILENAME), dtype=np.uint8, mode='r',
+                       shape=(meta['count'], *meta['shape']))
+    labels = np.load(os.path.join(store_dir, 'labels.npy'))
+    return images, labels, np.array(meta['classes']), meta
+
+def ensure_memmap_store(base_dir, store_dir, crop_cache_dir=None, num_workers=1, manifest_path=None):
+    """Reuses the store in store_dir if it matches the current dataset, otherwise rebuilds it. Returns True if a store is available."""
+    meta_path = os.path.join(store_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        manifest = update_manifest(base_dir, manifest_path) if manifest_path else None
+        if meta.get('shape') == [IMG_HEIGHT, IMG_WIDTH, 3] and meta.get('fingerprint') == dataset_fingerprint(base_dir, manifest):
+            print(f"Reusing memory-mapped store in '{store_dir}' ({meta['count']} images).")
+            return True
+        os.remove(meta_path)
+        print(f"Dataset changed since the store in '{store_dir}' was written. Rebuilding it...")
+    return build_memmap_store(base_dir, store_dir, crop_cache_dir=crop_cache_dir,
+                              num_workers=num_workers, manifest_path=manifest_path)
+
+class MemmapBatches(keras.utils.Sequence):
+    """
+    Serves batches from a memory-mapped uint8 store through an index view.
+    Only the rows of the current batch are read and converted to float32 with preprocess_input
+    (or passed through as float32 with preprocess=False, e.g. for memory-mapped backbone features).
+    """
+
+    def __init__(self, images, labels, indices, num_classes, batch_size=BATCH_SIZE, shuffle=False, preprocess=True):
+        super().__init__()
+        self.images = images
+        self.preprocess = preprocess
+        self.labels = labels
+        self.indices = np.array(indices)
+        self.num_classes = num_classes
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(42)
+        if shuffle:
+            self.rng.shuffle(self.indices)
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+    def __getitem__(self, batch_index):
+        # Sorted reads touch the file sequentially; order within a batch does not matter for training
+        batch_indices = np.sort(self.indices[batch_index * self.batch_size:(batch_index + 1) * self.batch_size])
+        x = self.images[batch_indices].astype(np.float32)
+        if self.preprocess:
+            x = tf.keras.applications.mobilenet_v2.preprocess_input(x)
+        y = tf.keras.utils.to_categorical(self.labels[batch_indices], num_classes=self.num_classes)
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.indices)
+
+def build_feature_extractor(input_shape):
+    """Builds the frozen MobileNetV2 backbone followed by GlobalAveragePooling2D (outputs FEATURE_DIM-d embeddings)."""
     # Load MobileNetV2 pre-trained on ImageNet, without the top classification layer
     base_model = MobileNetV2(weights='imagenet', include_top=False, input_shape=input_shape)
     
     # Freeze the layers of the base model so they are not trained initially
     base_model.trainable = False 
     
-    # Add custom layers on top of MobileNetV2
     x = base_model.output
     x = GlobalAveragePooling2D()(x) # Reduces spatial dimensions
-    x = Dense(1024, activation='relu')(x) # A fully connected layer
-    x = Dropout(0.5)(x) # Dropout for regularization to prevent overfitting
-    predictions = Dense(num_classes, activation='softmax')(x) # Output layer with softmax for multi-class classification
+    return Model(inputs=base_model.input, outputs=x)
+
+def add_classification_head(x, num_classes, dense_units=DENSE_UNITS, dropout_rate=DROPOUT_RATE):
+    """Adds the Dense/Dropout classification layers on top of pooled backbone features."""
+    x = Dense(dense_units, activation='relu')(x) # A fully connected layer
+    x = Dropout(dropout_rate)(x) # Dropout for regularization to prevent overfitting
+    return Dense(num_classes, activation='softmax')(x) # Output layer with softmax for multi-class classification
+
+def compile_model(model, learning_rate=LEARNING_RATE):
+    """Compiles a classifier with the optimizer, loss and metrics used for training."""
+    model.compile(optimizer=Adam(learning_rate=learning_rate), 
+                  loss='categorical_crossentropy', # For multi-class classification
+                  metrics=['accuracy'])
+    return model
+
+def build_model(num_classes, input_shape, learning_rate=LEARNING_RATE, dense_units=DENSE_UNITS, dropout_rate=DROPOUT_RATE):
+    """Builds a classification model using MobileNetV2 as a base."""
+    feature_extractor = build_feature_extractor(input_shape)
     
-    model = Model(inputs=base_model.input, outputs=predictions)
+    # Add custom layers on top of MobileNetV2
+    predictions = add_classification_head(feature_extractor.output, num_classes, dense_units, dropout_rate)
+    
+    model = Model(inputs=feature_extractor.input, outputs=predictions)
     
     # Compile the model
-    model.compile(optimizer=Adam(learning_rate=0.001), 
-                  loss='categorical_crossentropy', # For multi-class classification
-                  metrics=['accuracy'])
+    return compile_model(model, learning_rate=learning_rate)
+
+def build_head_model(num_classes, feature_dim=FEATURE_DIM, learning_rate=LEARNING_RATE, dense_units=DENSE_UNITS,
+                     dropout_rate=DROPOUT_RATE):
+    """Builds just the classification head, taking cached backbone embeddings as input."""
+    inputs = keras.Input(shape=(feature_dim,))
+    model = Model(inputs=inputs, outputs=add_classification_head(inputs, num_classes, dense_units, dropout_rate))
+    return compile_model(model, learning_rate=learning_rate)
+
+def attach_head_to_backbone(head_model, input_shape):
+    """
+    Stitches a head trained on cached embeddings back onto the frozen backbone.
+    The result has the same layers and weights layout as build_model, so it saves in the same format.
+    """
+    feature_extractor = build_feature_extractor(input_shape)
+    x = feature_extractor.output
+    for layer in head_model.layers[1:]: # Skip the head's Input layer, reuse the trained layers as-is
+        x = layer(x)
+    model = compile_model(Model(inputs=feature_extractor.input, outputs=x),
+                          learning_rate=float(head_model.optimizer.learning_rate.numpy()))
+    # Build the optimizer state now so the saved file loads cleanly, like a checkpoint written during fit
+    model.optimizer.build(model.trainable_variables)
     return model
 
-def main():
-    print("Step 1: Loading and preprocessing data...")
-    images, labels, class_names_loaded = load_and_preprocess_data(IMAGE_DIR)
+def feature_cache_key(img_path, bbox):
+    """Returns the feature cache key for an image: a hash of its file content, crop box, input size and backbone."""
+    digest = hashlib.sha1()
+    with open(img_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    digest.update(f"{bbox}|{IMG_WIDTH}x{IMG_HEIGHT}|{FEATURE_BACKBONE}|fast={FAST_DECODE}".encode())
+    return digest.hexdigest()
+
+def load_feature_cache(cache_path):
+    """Loads cached embeddings as a {key: vector} dict. A missing or unreadable cache is treated as empty."""
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with np.load(cache_path) as data:
+            return dict(zip(data['keys'].tolist(), data['features']))
+    except Exception as e:
+        print(f"Warning: Could not read feature cache '{cache_path}': {e}. Rebuilding it.")
+        return {}
+
+def save_feature_cache(cache_path, cache):
+    """Writes the {key: vector} cache to disk atomically."""
+    keys = sorted(cache)
+    features = np.array([cache[k] for k in keys], dtype=np.float32).reshape(len(keys), FEATURE_DIM)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, keys=np.array(keys), features=features)
+    os.replace(tmp_path, cache_path)
+
+def compute_cached_features(samples, input_shape, cache_path=FEATURE_CACHE_PATH):
+    """
+    Returns (features, label_indices) for (img_path, xml_path, class_index) samples.
+    Embeddings already in the cache are reused; the rest are computed once with the frozen backbone,
+    one batch at a time, and written back. Entries for images no longer in the dataset are dropped.
+    """
+    cache = load_feature_cache(cache_path)
+    keys, label_indices = [], []
+    pending = {}
+    for img_path, xml_path, class_index in samples:
+        try:
+            bbox = parse_bounding_box(xml_path)
+            if bbox is None:
+                continue
+            key = feature_cache_key(img_path, bbox)
+        except Exception as e:
+            report_load_error(e, img_path, xml_path)
+            continue
+        keys.append(key)
+        label_indices.append(class_index)
+        if key not in cache:
+            pending[key] = (img_path, xml_path, bbox)
+
+    print(f"Feature cache: {len(keys) - len(pending)} cached, {len(pending)} images to embed.")
+    if pending:
+        feature_extractor = build_feature_extractor(input_shape)
+        pending_items = list(pending.items())
+        for start in range(0, len(pending_items), BATCH_SIZE):
+            batch_keys, batch_images = [], []
+            for key, (img_path, xml_path, bbox) in pending_items[start:start + BATCH_SIZE]:
+                try:
+                    batch_images.append(crop_and_resize(img_path, bbox))
+                except Exception as e:
+                    report_load_error(e, img_path, xml_path)
+                    continue
+                batch_keys.append(key)
+            if not batch_images:
+                continue
+            batch = tf.keras.applications.mobilenet_v2.preprocess_input(np.array(batch_images, dtype=np.float32))
+            embeddings = np.asarray(feature_extractor.predict_on_batch(batch))
+            for key, embedding in zip(batch_keys, embeddings):
+                cache[key] = embedding
+
+    # Keep only samples with an embedding (decode failures were reported above) and evict stale entries
+    used = [(key, label) for key, label in zip(keys, label_indices) if key in cache]
+    used_keys = {key for key, _ in used}
+    if pending or len(used_keys) != len(cache):
+        save_feature_cache(cache_path, {key: cache[key] for key in used_keys})
+
+    if not used:
+        return np.zeros((0, FEATURE_DIM), dtype=np.float32), np.array([], dtype=int)
+    features = np.array([cache[key] for key, _ in used], dtype=np.float32)
+    return features, np.array([label for _, label in used])
+
+def prepare_in_memory_data(base_dir):
+    """
+    Loads the whole dataset into RAM and splits it into training and validation sets.
+    Returns (train_data, val_data, class_names) or None if there is nothing to train on.
+    train_data holds keyword arguments for model.fit; val_data is an (x, y) tuple or None.
+    """
+    images, labels, class_names_loaded = load_and_preprocess_data(base_dir, crop_cache_dir=CROP_CACHE_DIR,
+                                                                 num_workers=NUM_LOAD_WORKERS,
+                                                                 manifest_path=MANIFEST_PATH)
 
     if images.size == 0:
         print("No data was loaded. Please check your IMAGE_DIR and data structure. Exiting.")
-        return
+        return None
 
     num_classes = len(class_names_loaded)
     print(f"\nSuccessfully loaded {len(images)} images belonging to {num_classes} classes.")
     
     if num_classes == 0:
         print("No classes found. Cannot train a model. Exiting.")
-        return
+        return None
     if num_classes == 1:
         print("Warning: Only one class was found. Training a classifier requires at least two distinct classes.")
         # Consider exiting or specific handling if only one class. For now, will proceed but training won't be meaningful.
@@ -161,21 +1006,319 @@ def main():
     print(f"Shape of label data array: {labels.shape}")   # (num_samples, num_classes)
 
     # Step 2: Split data into training and validation sets
+    print("\nStep 2: Splitting data into training and validation sets...")
+    with metrics.timed('split', items=len(images), nbytes=images.nbytes):
+        x_train, x_val, y_train, y_val = train_test_split(
+            images, labels, 
+            test_size=VALIDATION_SPLIT, 
+            random_state=42, # For reproducibility
+            stratify=labels if num_classes > 1 else None # Ensure class proportions are similar in train/val splits
+        )
+    print(f"Training samples: {len(x_train)}, Validation samples: {len(x_val)}")
+
+    if len(x_train) == 0:
+        print("Error: No training samples after splitting. Check dataset size and validation split. Exiting.")
+        return None
+
+    train_data = {'x': x_train, 'y': y_train, 'batch_size': BATCH_SIZE}
+    val_data = (x_val, y_val) if len(x_val) > 0 else None
+    return train_data, val_data, class_names_loaded
+
+def prepare_streaming_data(base_dir):
+    """
+    Builds streaming tf.data pipelines for training and validation.
+    Returns (train_data, val_data, class_names) or None, in the same shape as prepare_in_memory_data.
+    """
+    train_ds, val_ds, class_names_loaded, num_train, num_val = build_streaming_datasets(base_dir)
+
+    if train_ds is None:
+        print("No data was found. Please check your IMAGE_DIR and data structure. Exiting.")
+        return None
+
+    num_classes = len(class_names_loaded)
+    if num_classes == 1:
+        print("Warning: Only one class was found. Training a classifier requires at least two distinct classes.")
+
+    print("\nStep 2: Split data into training and validation sets (by index, images are decoded per batch).")
+    print(f"Training samples: {num_train}, Validation samples: {num_val}")
+
+    if num_train == 0:
+        print("Error: No training samples after splitting. Check dataset size and validation split. Exiting.")
+        return None
+
+    # Batching happens inside the dataset, so batch_size must not be passed to model.fit
+    return {'x': train_ds}, val_ds, class_names_loaded
+
+def prepare_feature_cache_data(base_dir):
+    """
+    Computes (or loads cached) backbone embeddings for every image and splits them.
+    Returns (train_data, val_data, class_names) or None, in the same shape as prepare_in_memory_data,
+    with FEATURE_DIM-d vectors in place of images.
+    """
+    class_names, samples = list_dataset_samples(base_dir)
+    if not samples:
+        print("No data was found. Please check your IMAGE_DIR and data structure. Exiting.")
+        return None
+
+    features, label_indices = compute_cached_features(samples, (IMG_HEIGHT, IMG_WIDTH, 3))
+    if len(features) == 0:
+        print("Error: No images were successfully loaded. Please check paths, file formats, and XML content.")
+        return None
+
+    num_classes = len(class_names)
+    print(f"\nSuccessfully embedded {len(features)} images belonging to {num_classes} classes.")
+    if num_classes == 1:
+        print("Warning: Only one class was found. Training a classifier requires at least two distinct classes.")
+    labels = tf.keras.utils.to_categorical(label_indices, num_classes=num_classes)
+
     print("\nStep 2: Splitting data into training and validation sets...")
     x_train, x_val, y_train, y_val = train_test_split(
-        images, labels, 
-        test_size=VALIDATION_SPLIT, 
-        random_state=42, # For reproducibility
-        stratify=labels if num_classes > 1 else None # Ensure class proportions are similar in train/val splits
+        features, labels,
+        test_size=VALIDATION_SPLIT,
+        random_state=42,
+        stratify=labels if num_classes > 1 else None
     )
     print(f"Training samples: {len(x_train)}, Validation samples: {len(x_val)}")
 
     if len(x_train) == 0:
         print("Error: No training samples after splitting. Check dataset size and validation split. Exiting.")
+        return None
+
+    train_data = {'x': x_train, 'y': y_train, 'batch_size': BATCH_SIZE}
+    val_data = (x_val, y_val) if len(x_val) > 0 else None
+    return train_data, val_data, np.array(class_names)
+
+def prepare_memmap_data(base_dir):
+    """
+    Builds (or reuses) the memory-mapped uint8 store and splits it into index views.
+    Returns (train_data, val_data, class_names) or None, in the same shape as prepare_in_memory_data.
+    """
+    if not ensure_memmap_store(base_dir, MEMMAP_STORE_DIR, crop_cache_dir=CROP_CACHE_DIR,
+                               num_workers=NUM_LOAD_WORKERS, manifest_path=MANIFEST_PATH):
+        print("No data was loaded. Please check your IMAGE_DIR and data structure. Exiting.")
+        return None
+    images, labels, class_names_loaded, _ = open_memmap_store(MEMMAP_STORE_DIR)
+
+    num_classes = len(class_names_loaded)
+    print(f"\nImage store holds {len(images)} images belonging to {num_classes} classes.")
+    if num_classes == 1:
+        print("Warning: Only one class was found. Training a classifier requires at least two distinct classes.")
+
+    print("\nStep 2: Splitting data into training and validation sets (index views, no copies)...")
+    train_idx, val_idx = train_test_split(
+        np.arange(len(images)),
+        test_size=VALIDATION_SPLIT,
+        random_state=42,
+        stratify=labels if num_classes > 1 else None
+    )
+    print(f"Training samples: {len(train_idx)}, Validation samples: {len(val_idx)}")
+
+    if len(train_idx) == 0:
+        print("Error: No training samples after splitting. Check dataset size and validation split. Exiting.")
+        return None
+
+    train_data = {'x': MemmapBatches(images, labels, train_idx, num_classes, shuffle=True)}
+    val_data = MemmapBatches(images, labels, val_idx, num_classes) if len(val_idx) > 0 else None
+    return train_data, val_data, class_names_loaded
+
+def _sample_key(class_name, img_path, img_mtime, xml_mtime):
+    return f"{class_name}/{os.path.basename(img_path)}|{img_mtime}|{xml_mtime}"
+
+def scan_sample_keys(base_dir, manifest=None):
+    """
+    Returns {img_path: key} for every image with a sibling XML under base_dir, without printing warnings.
+    A key identifies one version of a sample: its relative path plus the image and XML mtimes.
+    With a manifest, the keys come from its rows instead of listing every folder again; update_manifest stats
+    the files of every row, so images and XMLs overwritten in place get a new key either way.
+    """
+    sample_keys = {}
+    if manifest is not None:
+        class_names = manifest['classes'].tolist()
+        for img_path, label, img_mtime, xml_mtime in zip(manifest['img_paths'].tolist(), manifest['labels'].tolist(),
+                                                         manifest['img_mtimes'].tolist(), manifest['xml_mtimes'].tolist()):
+            sample_keys[img_path] = _sample_key(class_names[label], img_path, img_mtime, xml_mtime)
+        return sample_keys
+    for class_name in list_class_names(base_dir):
+        class_path = os.path.join(base_dir, class_name)
+        for item_name in os.listdir(class_path):
+            if not item_name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            img_path = os.path.join(class_path, item_name)
+            xml_path = os.path.join(class_path, os.path.splitext(item_name)[0] + '.xml')
+            try:
+                img_stat, xml_stat = os.stat(img_path), os.stat(xml_path)
+            except OSError:
+                continue
+            sample_keys[img_path] = _sample_key(class_name, img_path, img_stat.st_mtime_ns, xml_stat.st_mtime_ns)
+    return sample_keys
+
+def load_training_state(state_path):
+    """Loads the training state written by save_training_state, or returns None if there is none."""
+    if not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read training state '{state_path}': {e}.")
+        return None
+
+def save_training_state(state_path, class_names, sample_keys, runs):
+    """Records the model's class order and the samples it has been trained on, atomically."""
+    state = {
+        'class_names': [str(name) for name in class_names],
+        'samples': sorted(sample_keys.values()),
+        'runs': runs,
+    }
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+def prepare_incremental_data(base_dir, training_state, sample_keys, manifest=None):
+    """
+    Loads only the images that are new or changed since the last run (per training_state), plus a replay
+    sample of already-trained images from every old class, and splits them.
+    Class folders not in the trained model are appended after the existing classes, so old output indices
+    keep their meaning. Files and bounding boxes come from the manifest when one is given.
+    Returns (train_data, val_data, class_names) or None, in the same shape as prepare_in_memory_data.
+    """
+    if manifest is not None:
+        class_names = manifest['classes'].tolist()
+        samples = [(img_path, xml_path, tuple(bbox), label) for img_path, xml_path, bbox, label in
+                   zip(manifest['img_paths'].tolist(), manifest['xml_paths'].tolist(),
+                       manifest['bboxes'].tolist(), manifest['labels'].tolist())]
+    else:
+        class_names, samples = list_dataset_samples(base_dir)
+        samples = [(img_path, xml_path, None, class_index) for img_path, xml_path, class_index in samples]
+    if not samples:
+        print("No data was found. Please check your IMAGE_DIR and data structure. Exiting.")
+        return None
+
+    trained_classes = list(training_state['class_names'])
+    removed_classes = [name for name in trained_classes if name not in class_names]
+    if removed_classes:
+        print(f"Warning: Class folders {removed_classes} no longer exist. The model keeps their outputs.")
+    merged_classes = trained_classes + [name for name in class_names if name not in trained_classes]
+    added_classes = merged_classes[len(trained_classes):]
+    if added_classes:
+        print(f"New classes since the last run: {added_classes}")
+
+    trained_keys = set(training_state['samples'])
+    new_items, old_items = [], {}
+    for img_path, xml_path, bbox, class_index in samples:
+        label = merged_classes.index(class_names[class_index])
+        if sample_keys.get(img_path) in trained_keys:
+            old_items.setdefault(label, []).append((img_path, xml_path, bbox, label))
+        else:
+            new_items.append((img_path, xml_path, bbox, label))
+    if not new_items:
+        print("No new or changed images since the last training run. Nothing to train.")
+        return None
+
+    # Seeded by the run counter, so a resumed run replays the same images as the interrupted one
+    rng = np.random.default_rng(training_state.get('runs', 0))
+    replay_per_class = max(REPLAY_MIN_PER_CLASS, int(np.ceil(REPLAY_RATIO * len(new_items) / max(1, len(old_items)))))
+    replay_items = []
+    for label in sorted(old_items):
+        chosen = rng.choice(len(old_items[label]), size=min(replay_per_class, len(old_items[label])), replace=False)
+        replay_items.extend(old_items[label][i] for i in sorted(chosen))
+    print(f"Incremental training on {len(new_items)} new or changed images and {len(replay_items)} replayed images "
+          f"(out of {sum(len(items) for items in old_items.values())} already trained).")
+
+    # The crop cache is not used here: saving it after loading a subset would evict every other entry
+    items = new_items + replay_items
+    executor = ProcessPoolExecutor(max_workers=NUM_LOAD_WORKERS) if NUM_LOAD_WORKERS > 1 else None
+    try:
+        crops = list(load_crops(((img_path, xml_path, bbox) for img_path, xml_path, bbox, _ in items),
+                                executor=executor, num_workers=NUM_LOAD_WORKERS))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    loaded = [(img_array, label) for img_array, (_, _, _, label) in zip(crops, items) if img_array is not None]
+    if not loaded:
+        print("Error: No images were successfully loaded. Please check paths, file formats, and XML content.")
+        return None
+
+    with metrics.timed('preprocess_input', items=len(loaded), nbytes=len(loaded) * loaded[0][0].nbytes * 4):
+        images = tf.keras.applications.mobilenet_v2.preprocess_input(
+            np.array([img_array for img_array, _ in loaded], dtype=np.float32))
+    label_indices = np.array([label for _, label in loaded])
+    labels = tf.keras.utils.to_categorical(label_indices, num_classes=len(merged_classes))
+
+    print("\nStep 2: Splitting data into training and validation sets...")
+    try:
+        x_train, x_val, y_train, y_val = train_test_split(
+            images, labels, test_size=VALIDATION_SPLIT, random_state=42, stratify=label_indices)
+    except ValueError: # A new class with a single image cannot be stratified
+        x_train, x_val, y_train, y_val = train_test_split(
+            images, labels, test_size=VALIDATION_SPLIT, random_state=42)
+    print(f"Training samples: {len(x_train)}, Validation samples: {len(x_val)}")
+
+    train_data = {'x': x_train, 'y': y_train, 'batch_size': BATCH_SIZE}
+    val_data = (x_val, y_val) if len(x_val) > 0 else None
+    return train_data, val_data, np.array(merged_classes)
+
+def load_incremental_model(model_path, num_classes):
+    """
+    Loads the last checkpoint for fine-tuning at INCREMENTAL_LEARNING_RATE. If there are more classes than
+    outputs, the softmax layer is replaced by a wider one that keeps the trained weights of the old classes.
+    """
+    model = keras.models.load_model(model_path)
+    output_layer = model.layers[-1]
+    trained_classes = output_layer.units
+    if num_classes < trained_classes:
+        raise ValueError(f"Checkpoint '{model_path}' has {trained_classes} outputs but the training state lists "
+                         f"only {num_classes} classes.")
+    if num_classes > trained_classes:
+        kernel, bias = output_layer.get_weights()
+        # Named by class count: auto-generated names could clash with the loaded layers
+        grown_layer = Dense(num_classes, activation='softmax', name=f'predictions_{num_classes}')
+        predictions = grown_layer(model.layers[-2].output)
+        grown_kernel, grown_bias = grown_layer.get_weights()
+        grown_kernel[:, :trained_classes] = kernel
+        grown_bias[:trained_classes] = bias
+        grown_layer.set_weights([grown_kernel, grown_bias])
+        model = Model(inputs=model.input, outputs=predictions)
+        print(f"Grew the output layer from {trained_classes} to {num_classes} classes.")
+    return compile_model(model, learning_rate=INCREMENTAL_LEARNING_RATE)
+
+def evaluate_model(model, val_data):
+    """Evaluates the model on an (x, y) tuple or a tf.data dataset. Returns (loss, accuracy)."""
+    if isinstance(val_data, tuple):
+        return model.evaluate(*val_data, verbose=0)
+    return model.evaluate(val_data, verbose=0)
+
+def main():
+    metrics.reset()
+    manifest, sample_keys, training_state = None, None, None
+    if INCREMENTAL_TRAINING:
+        manifest = update_manifest(IMAGE_DIR, MANIFEST_PATH) if MANIFEST_PATH else None
+        # Collected up front, so images arriving during training are still new for the next incremental run
+        sample_keys = scan_sample_keys(IMAGE_DIR, manifest)
+        training_state = load_training_state(TRAINING_STATE_PATH)
+    incremental = INCREMENTAL_TRAINING and training_state is not None and os.path.exists(MODEL_CHECKPOINT_PATH)
+    if INCREMENTAL_TRAINING and not incremental:
+        print(f"No checkpoint or training state ('{MODEL_CHECKPOINT_PATH}', '{TRAINING_STATE_PATH}') yet. Running full training.")
+
+    print("Step 1: Loading and preprocessing data...")
+    if incremental:
+        prepared = prepare_incremental_data(IMAGE_DIR, training_state, sample_keys, manifest)
+    elif DATA_PIPELINE == 'streaming':
+        prepared = prepare_streaming_data(IMAGE_DIR)
+    elif DATA_PIPELINE == 'feature_cache':
+        prepared = prepare_feature_cache_data(IMAGE_DIR)
+    elif DATA_PIPELINE == 'memmap':
+        prepared = prepare_memmap_data(IMAGE_DIR)
+    else:
+        prepared = prepare_in_memory_data(IMAGE_DIR)
+    if prepared is None:
         return
+    train_data, val_data, class_names_loaded = prepared
+    num_classes = len(class_names_loaded)
     
     # It's crucial to have validation data for EarlyStopping and ModelCheckpoint to work effectively
-    if len(x_val) == 0:
+    if val_data is None:
         print("Warning: No validation samples after splitting. EarlyStopping and ModelCheckpoint based on validation metrics will not function correctly. Consider reducing VALIDATION_SPLIT or increasing dataset size.")
         # Training will proceed, but callbacks monitoring 'val_loss' or 'val_accuracy' will not trigger as expected.
 
@@ -183,50 +1326,65 @@ def main():
     # Step 3: Build the model
     print("\nStep 3: Building the model...")
     model_input_shape = (IMG_HEIGHT, IMG_WIDTH, 3)
-    model = build_model(num_classes=num_classes, input_shape=model_input_shape)
+    if incremental:
+        model = load_incremental_model(MODEL_CHECKPOINT_PATH, num_classes)
+    elif DATA_PIPELINE == 'feature_cache':
+        # Only the head is trained; the backbone is attached again before saving (Step 7)
+        model = build_head_model(num_classes=num_classes)
+    else:
+        model = build_model(num_classes=num_classes, input_shape=model_input_shape)
     model.summary() # Print model architecture
 
     # Step 4: Define Callbacks
     print("\nStep 4: Defining callbacks (EarlyStopping and ModelCheckpoint)...")
     
     callbacks_list = []
-    if len(x_val) > 0: # Only add callbacks if there is validation data
+    if val_data is not None: # Only add callbacks if there is validation data
         early_stopping = EarlyStopping(
             monitor='val_loss', # Monitor validation loss
-            patience=10,        # Number of epochs with no improvement after which training will be stopped
+            patience=EARLY_STOPPING_PATIENCE, # Number of epochs with no improvement after which training will be stopped
             verbose=1,
             restore_best_weights=True # Restores model weights from the epoch with the best value of the monitored quantity.
         )
         callbacks_list.append(early_stopping)
 
-        model_checkpoint = ModelCheckpoint(
-            filepath=MODEL_CHECKPOINT_PATH, # Path where to save the model
-            monitor='val_loss',          # Monitor validation loss
-            save_best_only=True,         # If True, the latest best model according to the quantity monitored will not be overwritten.
-            verbose=1
-        )
-        callbacks_list.append(model_checkpoint)
+        # A head-only checkpoint would not load as a full classifier, so in feature_cache mode
+        # the best head (restored by EarlyStopping) is saved with its backbone in Step 7 instead.
+        if incremental or DATA_PIPELINE != 'feature_cache':
+            model_checkpoint = ModelCheckpoint(
+                filepath=MODEL_CHECKPOINT_PATH, # Path where to save the model
+                monitor='val_loss',          # Monitor validation loss
+                save_best_only=True,         # If True, the latest best model according to the quantity monitored will not be overwritten.
+                verbose=1
+            )
+            callbacks_list.append(model_checkpoint)
     else:
         print("Skipping EarlyStopping and ModelCheckpoint as there is no validation data.")
+    # Per-epoch images/sec and step-time percentiles for the metrics log
+    callbacks_list.append(ThroughputCallback(BATCH_SIZE, num_images=len(train_data['y']) if 'y' in train_data else None))
+    if incremental:
+        # Saves weights, optimizer state and the epoch counter every epoch; an interrupted run resumes from there
+        callbacks_list.append(BackupAndRestore(backup_dir=INCREMENTAL_BACKUP_DIR))
 
 
     # Step 5: Train the model
     print("\nStep 5: Starting model training...")
-    history = model.fit(
-        x_train, y_train,
-        batch_size=BATCH_SIZE,
-        epochs=EPOCHS,
-        validation_data=(x_val, y_val) if len(x_val) > 0 else None,
-        callbacks=callbacks_list if callbacks_list else None, # Pass the list of callbacks
-        verbose=1
-    )
+    with metrics.timed('fit'):
+        history = model.fit(
+            **train_data,
+            epochs=INCREMENTAL_EPOCHS if incremental else EPOCHS,
+            validation_data=val_data,
+            callbacks=callbacks_list if callbacks_list else None, # Pass the list of callbacks
+            verbose=1
+        )
     print("Training finished.")
 
     # Step 6: Evaluate the model (optional, as fit() already shows validation metrics)
     # If EarlyStopping restored best weights, this evaluation will be on those best weights.
-    if len(x_val) > 0:
+    if val_data is not None:
         print("\nStep 6: Evaluating model on validation set (potentially with best weights restored by EarlyStopping)...")
-        loss, accuracy = model.evaluate(x_val, y_val, verbose=0)
+        with metrics.timed('evaluate'):
+            loss, accuracy = evaluate_model(model, val_data)
         print(f"Validation Accuracy: {accuracy*100:.2f}%")
         print(f"Validation Loss: {loss:.4f}")
 
@@ -234,6 +1392,11 @@ def main():
     # If ModelCheckpoint was used, the 'best_image_classifier_model.keras' already holds the best version.
     # If EarlyStopping with restore_best_weights=True was used, the current `model` object has the best weights.
     # Saving it again here ensures the model is saved even if ModelCheckpoint wasn't the primary way of getting the best model.
+    if DATA_PIPELINE == 'feature_cache' and not incremental:
+        print("\nAttaching the trained head to the MobileNetV2 backbone...")
+        model = attach_head_to_backbone(model, model_input_shape)
+        if val_data is not None:
+            model.save(MODEL_CHECKPOINT_PATH)
     final_model_save_path = 'final_image_classifier_model.keras'
     model.save(final_model_save_path)
     print(f"\nFinal model (potentially best weights) saved to {final_model_save_path}")
@@ -244,6 +1407,30 @@ def main():
     print("\nClass mapping (index to name) used by the model:")
     for i, name in enumerate(class_names_loaded):
         print(f"Index {i}: {name}")
+    with open(CLASS_NAMES_PATH, 'w') as f:
+        json.dump([str(name) for name in class_names_loaded], f)
+    print(f"Class names saved to {CLASS_NAMES_PATH}")
+    if sample_keys is not None:
+        save_training_state(TRAINING_STATE_PATH, class_names_loaded, sample_keys,
+                            runs=training_state['runs'] + 1 if training_state else 1)
+        print(f"Training state saved to {TRAINING_STATE_PATH}")
+
+    metrics.write_json(METRICS_LOG_PATH)
+    print(f"Pipeline metrics appended to {METRICS_LOG_PATH}")
+    if METRICS_PROMETHEUS_PATH:
+        metrics.write_prometheus(METRICS_PROMETHEUS_PATH)
+        print(f"Prometheus metrics written to {METRICS_PROMETHEUS_PATH}")
+
+    # Step 8 (optional): Export quantized TFLite models for offline/edge use and benchmark them
+    if EXPORT_TFLITE:
+        print("\nStep 8: Exporting TFLite models and benchmarking them on the validation set...")
+        from export_tflite import export_and_benchmark
+        if DATA_PIPELINE == 'feature_cache' and not incremental:
+            # The head was trained on embeddings, so stream the images again for calibration and benchmarking
+            train_images, val_images, _, _, _ = build_streaming_datasets(IMAGE_DIR)
+            export_and_benchmark(model, train_images, val_images)
+        else:
+            export_and_benchmark(model, train_data, val_data)
 
 def create_dummy_data_if_needed():
     """Creates a dummy directory structure and files if IMAGE_DIR doesn't exist."""
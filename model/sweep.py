@@ -0,0 +1,278 @@
+import os
+import csv
+import json
+import time
+import shutil
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import tensorflow as tf
+import keras
+from keras.callbacks import EarlyStopping
+from sklearn.model_selection import train_test_split
+import model as pipeline
+
+# --- Configuration ---
+SWEEP_DIR = 'sweep' # Shared data, per-trial checkpoints and the results table
+SWEEP_DATA = 'features' # 'features': train heads on backbone embeddings computed once; 'images': full models on the memmap store
+SEARCH_MODE = 'random' # 'grid' tries every combination of SEARCH_SPACE; 'random' samples NUM_TRIALS of them
+NUM_TRIALS = 12
+SEARCH_SPACE = {
+    'learning_rate': [0.0003, 0.001, 0.003],
+    'dense_units': [256, 512, 1024],
+    'dropout_rate': [0.3, 0.5],
+    'batch_size': [16, 32, 64],
+    'patience': [3, 5, 10],
+}
+MIN_EPOCHS = 3 # Epochs every trial gets in the first rung
+MAX_EPOCHS = 27 # Epochs the surviving trials reach in the last rung
+REDUCTION_FACTOR = 3 # Each rung keeps the best 1/REDUCTION_FACTOR of the trials and trains them REDUCTION_FACTOR times longer
+SWEEP_WORKERS = 2 # Trial processes running at the same time
+BEST_MODEL_PATH = 'sweep_best_model.keras'
+SEED = 42
+
+def make_configs(search_space=SEARCH_SPACE, mode=SEARCH_MODE, num_trials=NUM_TRIALS, seed=SEED):
+    """Returns the trial configurations: the full grid, or num_trials distinct random picks from it."""
+    names = list(search_space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*(search_space[name] for name in names))]
+    if mode == 'grid' or num_trials >= len(grid):
+        return grid
+    rng = np.random.default_rng(seed)
+    return [grid[i] for i in sorted(rng.choice(len(grid), size=num_trials, replace=False))]
+
+def prepare_shared_data(sweep_dir=SWEEP_DIR, data_kind=SWEEP_DATA):
+    """
+    Decodes and preprocesses the dataset once and writes everything the trials need into sweep_dir.
+    'features' runs the frozen backbone once per image (reusing FEATURE_CACHE_PATH) and saves the embeddings
+    as a .npy file; 'images' builds or reuses the memory-mapped uint8 crop store. Returns the data spec
+    passed to every trial, or None if there is nothing to train on.
+    """
+    os.makedirs(sweep_dir, exist_ok=True)
+    if data_kind == 'features':
+        class_names, samples = pipeline.list_dataset_samples(pipeline.IMAGE_DIR)
+        if not samples:
+            return None
+        features, labels = pipeline.compute_cached_features(samples, (pipeline.IMG_HEIGHT, pipeline.IMG_WIDTH, 3))
+        if len(features) == 0:
+            return None
+        data_path = os.path.join(sweep_dir, 'features.npy')
+        np.save(data_path, features)
+    else:
+        if not pipeline.ensure_memmap_store(pipeline.IMAGE_DIR, pipeline.MEMMAP_STORE_DIR,
+                                            crop_cache_dir=pipeline.CROP_CACHE_DIR,
+                                            num_workers=pipeline.NUM_LOAD_WORKERS,
+                                            manifest_path=pipeline.MANIFEST_PATH):
+            return None
+        _, labels, class_names, _ = pipeline.open_memmap_store(pipeline.MEMMAP_STORE_DIR)
+        data_path = pipeline.MEMMAP_STORE_DIR
+
+    num_classes = len(class_names)
+    train_idx, val_idx = train_test_split(
+        np.arange(len(labels)),
+        test_size=pipeline.VALIDATION_SPLIT,
+        random_state=42,
+        stratify=labels if num_classes > 1 else None
+    )
+    if len(val_idx) == 0:
+        print("Error: The sweep ranks trials by validation loss, but there are no validation samples. Exiting.")
+        return None
+    np.save(os.path.join(sweep_dir, 'labels.npy'), np.asarray(labels, dtype=np.int32))
+    np.save(os.path.join(sweep_dir, 'train_idx.npy'), train_idx)
+    np.save(os.path.join(sweep_dir, 'val_idx.npy'), val_idx)
+    print(f"Shared {data_kind} for {len(labels)} images: {len(train_idx)} training, {len(val_idx)} validation.")
+    return {'kind': data_kind, 'path': data_path, 'sweep_dir': sweep_dir,
+            'class_names': [str(name) for name in class_names]}
+
+def _init_trial_process(threads):
+    # Split the cores between trial processes instead of each one sizing its thread pools for the whole machine
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(min(2, threads))
+
+def run_trial(trial_id, config, data_spec, initial_epoch, epochs):
+    """
+    Trains one trial from initial_epoch up to epochs, continuing from its checkpoint (weights and optimizer
+    state) when it has one, and saves the checkpoint again. Runs in a trial process; the shared data is
+    opened read-only through memory maps, so no image is decoded or copied per trial.
+    Returns {'val_loss', 'val_accuracy', 'epochs', 'stopped_early', 'seconds'}.
+    """
+    start = time.perf_counter()
+    keras.backend.clear_session() # Trial processes are reused; drop the previous trial's graphs and layers
+    keras.utils.set_random_seed(SEED + trial_id)
+    sweep_dir = data_spec['sweep_dir']
+    num_classes = len(data_spec['class_names'])
+    labels = np.load(os.path.join(sweep_dir, 'labels.npy'))
+    train_idx = np.load(os.path.join(sweep_dir, 'train_idx.npy'))
+    val_idx = np.load(os.path.join(sweep_dir, 'val_idx.npy'))
+
+    # Both kinds are read batch by batch through index views, so trial processes share the mapped pages
+    if data_spec['kind'] == 'features':
+        data, preprocess = np.load(data_spec['path'], mmap_mode='r'), False
+    else:
+        (data, _, _, _), preprocess = pipeline.open_memmap_store(data_spec['path']), True
+    train_data = {'x': pipeline.MemmapBatches(data, labels, train_idx, num_classes, batch_size=config['batch_size'],
+                                              shuffle=True, preprocess=preprocess)}
+    val_data = pipeline.MemmapBatches(data, labels, val_idx, num_classes, batch_size=config['batch_size'],
+                                      preprocess=preprocess)
+
+    checkpoint_path = os.path.join(sweep_dir, f'trial_{trial_id:03d}.keras')
+    if os.path.exists(checkpoint_path):
+        model = keras.models.load_model(checkpoint_path)
+    elif data_spec['kind'] == 'features':
+        model = pipeline.build_head_model(num_classes, learning_rate=config['learning_rate'],
+                                          dense_units=config['dense_units'], dropout_rate=config['dropout_rate'])
+    else:
+        model = pipeline.build_model(num_classes, (pipeline.IMG_HEIGHT, pipeline.IMG_WIDTH, 3),
+                                     learning_rate=config['learning_rate'], dense_units=config['dense_units'],
+                                     dropout_rate=config['dropout_rate'])
+
+    early_stopping = EarlyStopping(monitor='val_loss', patience=config['patience'], restore_best_weights=True)
+    history = model.fit(**train_data, epochs=epochs, initial_epoch=initial_epoch,
+                        validation_data=val_data,
+                        callbacks=[early_stopping], verbose=0)
+    loss, accuracy = pipeline.evaluate_model(model, val_data)
+    model.save(checkpoint_path)
+    return {
+        'val_loss': float(loss),
+        'val_accuracy': float(accuracy),
+        'epochs': initial_epoch + len(history.history.get('loss', [])),
+        'stopped_early': early_stopping.stopped_epoch > 0,
+        'seconds': time.perf_counter() - start,
+    }
+
+def successive_halving(configs, data_spec, workers=SWEEP_WORKERS, min_epochs=MIN_EPOCHS, max_epochs=MAX_EPOCHS,
+                       reduction_factor=REDUCTION_FACTOR):
+    """
+    Runs the trials in rungs: every trial trains for min_epochs, then only the best 1/reduction_factor
+    (by validation loss) continue, each rung reduction_factor times longer, until max_epochs.
+    Trials that early-stop keep their result but are not trained further. Pruned trials lose their checkpoint,
+    so only 'completed' and 'stopped_early' trials can be saved. Returns one record per trial.
+    """
+    trials = [{'trial': i, 'config': config, 'epochs': 0, 'rung': 0, 'status': 'running',
+               'val_loss': float('inf'), 'val_accuracy': 0.0, 'seconds': 0.0}
+              for i, config in enumerate(configs)]
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    active = list(trials)
+    rung, rung_epochs = 0, min(min_epochs, max_epochs)
+    # 'spawn' because the parent has already initialised TensorFlow, which is not safe to fork
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_trial_process, initargs=(threads,)) as executor:
+        while active:
+            print(f"\nRung {rung}: training {len(active)} trials up to epoch {rung_epochs}...")
+            futures = {executor.submit(run_trial, trial['trial'], trial['config'], data_spec, trial['epochs'], rung_epochs): trial
+                       for trial in active}
+            for future in as_completed(futures):
+                trial = futures[future]
+                trial['rung'] = rung
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Warning: Trial {trial['trial']} failed: {e}")
+                    trial['status'] = 'failed'
+                    continue
+                trial['seconds'] += result.pop('seconds')
+                trial.update(result)
+                if trial.pop('stopped_early'):
+                    trial['status'] = 'stopped_early'
+                print(f"Trial {trial['trial']:>3}: val_loss {trial['val_loss']:.4f}, val_accuracy "
+                      f"{trial['val_accuracy']*100:.1f}% after {trial['epochs']} epochs {trial['config']}")
+
+            ranked = sorted((trial for trial in active if trial['status'] != 'failed'), key=lambda t: t['val_loss'])
+            if rung_epochs >= max_epochs:
+                for trial in ranked:
+                    if trial['status'] == 'running':
+                        trial['status'] = 'completed'
+                break
+            keep = max(1, len(ranked) // reduction_factor)
+            for trial in ranked[keep:]:
+                if trial['status'] == 'running':
+                    trial['status'] = 'pruned'
+                    os.remove(os.path.join(data_spec['sweep_dir'], f"trial_{trial['trial']:03d}.keras"))
+            active = [trial for trial in ranked[:keep] if trial['status'] == 'running']
+            rung += 1
+            rung_epochs = min(max_epochs, rung_epochs * reduction_factor)
+    return trials
+
+FINISHED_STATUSES = ('completed', 'stopped_early') # Trials that keep their checkpoint to the end of the sweep
+
+def write_results(trials, results_path):
+    """
+    Writes the trials as a CSV table and prints it: finished trials first, then pruned, then failed ones,
+    each by validation loss. A pruned trial's loss is from an earlier rung, so it is not compared with the
+    finished ones (a survivor's loss can get worse in a later rung). Returns the ranked list.
+    """
+    order = {'failed': 2, 'pruned': 1}
+    ranked = sorted(trials, key=lambda t: (order.get(t['status'], 0), t['val_loss']))
+    names = list(SEARCH_SPACE)
+    with open(results_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank', 'trial'] + names + ['epochs', 'rung', 'status', 'val_loss', 'val_accuracy', 'seconds'])
+        for rank, trial in enumerate(ranked, 1):
+            writer.writerow([rank, trial['trial']] + [trial['config'][name] for name in names] +
+                            [trial['epochs'], trial['rung'], trial['status'], round(trial['val_loss'], 6),
+                             round(trial['val_accuracy'], 6), round(trial['seconds'], 2)])
+
+    print(f"\n{'Rank':<6}{'Trial':<7}" + ''.join(f"{name:<15}" for name in names) +
+          f"{'Epochs':<8}{'Status':<15}{'Val loss':>10}{'Val acc':>9}")
+    for rank, trial in enumerate(ranked, 1):
+        print(f"{rank:<6}{trial['trial']:<7}" + ''.join(f"{trial['config'][name]:<15}" for name in names) +
+              f"{trial['epochs']:<8}{trial['status']:<15}{trial['val_loss']:>10.4f}{trial['val_accuracy']*100:>8.1f}%")
+    print(f"Results table saved to {results_path}")
+    return ranked
+
+def save_best_model(best_trial, data_spec, output_path=BEST_MODEL_PATH):
+    """Saves the best trial as a full image classifier (re-attaching the backbone in 'features' mode) with its class names."""
+    checkpoint_path = os.path.join(data_spec['sweep_dir'], f"trial_{best_trial['trial']:03d}.keras")
+    if data_spec['kind'] == 'features':
+        head_model = keras.models.load_model(checkpoint_path)
+        model = pipeline.attach_head_to_backbone(head_model, (pipeline.IMG_HEIGHT, pipeline.IMG_WIDTH, 3))
+        model.save(output_path)
+    else:
+        shutil.copyfile(checkpoint_path, output_path)
+    class_names_path = os.path.splitext(output_path)[0] + '_class_names.json'
+    with open(class_names_path, 'w') as f:
+        json.dump(data_spec['class_names'], f)
+    print(f"Best model (trial {best_trial['trial']}) saved to {output_path}, class names to {class_names_path}")
+    print("Best configuration: " + ', '.join(f"{name}={value}" for name, value in best_trial['config'].items()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep with successive halving over a dataset decoded once.")
+    parser.add_argument('--data', default=pipeline.IMAGE_DIR, help="Dataset directory (class folders with images and VOC XMLs)")
+    parser.add_argument('--mode', choices=('grid', 'random'), default=SEARCH_MODE)
+    parser.add_argument('--trials', type=int, default=NUM_TRIALS, help="Configurations sampled in random mode")
+    parser.add_argument('--data-kind', choices=('features', 'images'), default=SWEEP_DATA)
+    parser.add_argument('--workers', type=int, default=SWEEP_WORKERS)
+    parser.add_argument('--min-epochs', type=int, default=MIN_EPOCHS)
+    parser.add_argument('--max-epochs', type=int, default=MAX_EPOCHS)
+    parser.add_argument('--reduction-factor', type=int, default=REDUCTION_FACTOR)
+    parser.add_argument('--sweep-dir', default=SWEEP_DIR)
+    parser.add_argument('--output', default=BEST_MODEL_PATH)
+    args = parser.parse_args()
+    pipeline.IMAGE_DIR = args.data
+
+    # Trial checkpoints from an earlier sweep must not be resumed by trials with the same number
+    if os.path.isdir(args.sweep_dir):
+        for name in os.listdir(args.sweep_dir):
+            if name.startswith('trial_') and name.endswith('.keras'):
+                os.remove(os.path.join(args.sweep_dir, name))
+
+    print("Step 1: Decoding and preprocessing the dataset once for all trials...")
+    data_spec = prepare_shared_data(args.sweep_dir, args.data_kind)
+    if data_spec is None:
+        print("No data was loaded. Please check the data directory and its structure. Exiting.")
+        return
+
+    configs = make_configs(mode=args.mode, num_trials=args.trials)
+    print(f"\nStep 2: Running {len(configs)} trials ({args.mode} search) on {args.workers} worker processes...")
+    trials = successive_halving(configs, data_spec, workers=args.workers, min_epochs=args.min_epochs,
+                                max_epochs=args.max_epochs, reduction_factor=args.reduction_factor)
+
+    ranked = write_results(trials, os.path.join(args.sweep_dir, 'results.csv'))
+    if ranked and ranked[0]['status'] in FINISHED_STATUSES:
+        save_best_model(ranked[0], data_spec, args.output)
+    else:
+        print("Error: No trial finished, so there is no model to save.")
+
+if __name__ == '__main__':
+    main()